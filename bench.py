@@ -0,0 +1,286 @@
+"""Офлайн бенчмарк анализа: гоняет настоящие хендлеры main.py на поддельных
+Telethon и g4f с настраиваемыми задержками и частотой ошибок.
+
+Примеры:
+    python bench.py                              # папки из 1, 50 и 500 каналов
+    python bench.py --sizes 50 --runs 40 --concurrency 8 --llm-error-rate 0.3
+    python bench.py --startup-budget-ms          # проверка времени импорта main.py
+"""
+import argparse
+import asyncio
+import math
+import os
+import random
+import re
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+BENCH_ENV = {
+    'BOT_TOKEN': '123456789:AAbenchbenchbenchbenchbenchbenchbench',
+    'API_ID': '1',
+    'API_HASH': 'bench',
+    'METRICS_PORT': '0',
+}
+LATEST_JOB_IDS = {}
+STARTUP_BUDGET_MS = 1500  # бюджет импорта main.py, его же проверяет tests/test_startup.py
+
+def sample_latency(median_ms: float, sigma: float) -> float:
+    """Логнормальная задержка в секундах с заданной медианой"""
+    if median_ms <= 0:
+        return 0.0
+    return random.lognormvariate(math.log(median_ms / 1000), sigma)
+
+class FakeMessage:
+    def __init__(self, message_id: int, date: datetime, text: str):
+        self.id = message_id
+        self.date = date
+        self.text = text
+
+class FakeTelegramClient:
+    """Подмена TelegramClient: get_entity, get_input_entity, JoinChannelRequest и iter_messages"""
+    def __init__(self, args):
+        self.args = args
+
+    async def get_entity(self, channel_link: str):
+        await asyncio.sleep(sample_latency(self.args.fetch_latency_ms / 4, self.args.jitter))
+        return SimpleNamespace(username=channel_link.lstrip('@'), date=datetime.now(timezone.utc))
+
+    get_input_entity = get_entity
+
+    async def __call__(self, request):
+        return None
+
+    async def iter_messages(self, entity, limit=None, **kwargs):
+        # Telegram отдает историю страницами по 100 сообщений
+        await asyncio.sleep(sample_latency(self.args.fetch_latency_ms, self.args.jitter))
+        if random.random() < self.args.fetch_error_rate:
+            raise ConnectionError("bench: ошибка сети Telegram")
+        now = datetime.now(timezone.utc)
+        count = self.args.posts_per_channel if limit is None else min(limit, self.args.posts_per_channel)
+        for i in range(count):
+            if i and i % 100 == 0:
+                await asyncio.sleep(sample_latency(self.args.fetch_latency_ms, self.args.jitter))
+            date = now - timedelta(minutes=i * 24 * 60 / max(count, 1))
+            text = f"Пост {i} канала {entity.username}. " + "Текст новости. " * random.randint(5, 60)
+            yield FakeMessage(count - i, date, text)
+
+class FakeChatCompletion:
+    def __init__(self, args):
+        self.args = args
+        self.calls = 0
+
+    async def create_async(self, model, messages, provider=None, **kwargs):
+        self.calls += 1
+        await asyncio.sleep(sample_latency(self.args.llm_latency_ms, self.args.jitter))
+        if random.random() < self.args.llm_error_rate:
+            raise Exception(random.choice(["429 Too Many Requests", "Timeout", "500 Internal Server Error"]))
+        return f"### Отчет\n**Модель:** {model}\nПолучено символов: {len(messages[-1]['content'])}"
+
+class FakeProviders:
+    def __getattr__(self, name):
+        return type(name, (), {})
+
+def make_fake_g4f(args):
+    return SimpleNamespace(
+        debug=SimpleNamespace(logging=False),
+        check_version=False,
+        ChatCompletion=FakeChatCompletion(args),
+        Provider=FakeProviders(),
+    )
+
+class FakeBotMessage:
+    """Сообщение бота, в которое хендлеры пишут ответы"""
+    def __init__(self, chat_id: int):
+        self.chat = SimpleNamespace(id=chat_id)
+        self.sent = []
+
+    async def answer(self, text, **kwargs):
+        self.sent.append(text)
+        return self
+
+    async def edit_text(self, text, **kwargs):
+        self.sent.append(text)
+        return self
+
+class FakeBot:
+    """Подмена aiogram Bot для воркеров: считает сообщения и документы по чатам"""
+    def __init__(self):
+        self.messages = {}
+        self.documents = {}
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.messages[chat_id] = self.messages.get(chat_id, 0) + 1
+
+    def _sent_document(self, chat_id, document):
+        if hasattr(document, 'get_file'):
+            document.get_file().read()
+        self.documents[chat_id] = self.documents.get(chat_id, 0) + 1
+        return SimpleNamespace(document=SimpleNamespace(file_id=f"bench-file-{uuid.uuid4().hex}"))
+
+    async def send_document(self, chat_id, document, caption=None, **kwargs):
+        return self._sent_document(chat_id, document)
+
+    async def send_media_group(self, chat_id, media, **kwargs):
+        return [self._sent_document(chat_id, item.file or item.media) for item in media.media]
+
+def make_callback_query(user_id: int, data: str):
+    return SimpleNamespace(
+        data=data,
+        from_user=SimpleNamespace(id=user_id),
+        message=FakeBotMessage(user_id),
+    )
+
+def percentile(values: list, q: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, math.ceil(q / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+def peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # В Linux ru_maxrss в килобайтах, в macOS - в байтах
+    return peak / 1024 / 1024 if sys.platform == 'darwin' else peak / 1024
+
+async def run_scenario(main, args, size: int) -> dict:
+    """Гоняем process_analysis_choice по папке из size каналов"""
+    user_ids = [10_000_000 + size * 1000 + i for i in range(args.runs)]
+    for user_id in user_ids:
+        user = main.user_data.get_user_data(user_id)
+        user['folders']['bench'] = [f"@bench_channel_{n}" for n in range(size)]
+        user['prompts']['bench'] = "Проанализируй посты и составь краткий отчет"
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+    latencies = []
+    failures = 0
+
+    async def one_run(user_id: int):
+        nonlocal failures
+        async with semaphore:
+            query = make_callback_query(user_id, f"analyze_bench_{args.format}")
+            started = time.perf_counter()
+            # Хендлер только ставит задачу, ждем, пока ее выполнит воркер
+            await main.process_analysis_choice(query)
+            job_id = LATEST_JOB_IDS[user_id]
+            while main.get_job_status(job_id) not in ('done', 'failed'):
+                await asyncio.sleep(0.02)
+            latencies.append(time.perf_counter() - started)
+            if main.bot.documents.get(user_id, 0) == 0:
+                failures += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one_run(user_id) for user_id in user_ids))
+    wall = time.perf_counter() - started
+    return {
+        'size': size,
+        'runs': len(latencies),
+        'failures': failures,
+        'throughput': len(latencies) / wall if wall else 0.0,
+        'p50': percentile(latencies, 50),
+        'p99': percentile(latencies, 99),
+        'mean': statistics.mean(latencies),
+        'rss': peak_rss_mb(),
+    }
+
+def check_startup(budget_ms: float) -> bool:
+    """Меряем время импорта main.py через python -X importtime"""
+    workdir = tempfile.mkdtemp(prefix='suckfox_bench_')
+    env = dict(os.environ, **BENCH_ENV, LOG_FILE=os.path.join(workdir, 'bot.log'),
+               PYTHONPATH=REPO_DIR)
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import main'],
+        cwd=workdir, env=env, capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        print(result.stderr[-2000:])
+        return False
+    total_us = 0
+    for line in result.stderr.splitlines():
+        match = re.match(r'import time:\s+\d+ \|\s+(\d+) \| main$', line)
+        if match:
+            total_us = int(match.group(1))
+    total_ms = total_us / 1000
+    ok = total_ms <= budget_ms
+    print(f"Импорт main.py: {total_ms:.0f} мс (бюджет {budget_ms:.0f} мс) - {'OK' if ok else 'ПРЕВЫШЕН'}")
+    return ok
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='1,50,500', help='размеры папок (каналов), через запятую')
+    parser.add_argument('--runs', type=int, default=10, help='запусков анализа на каждый размер')
+    parser.add_argument('--concurrency', type=int, default=4, help='одновременных запусков')
+    parser.add_argument('--format', default='txt', choices=['txt', 'pdf', 'both'])
+    parser.add_argument('--posts-per-channel', type=int, default=20)
+    parser.add_argument('--accounts', type=int, default=1, help='аккаунтов в пуле Telethon')
+    parser.add_argument('--account-rps', type=float, default=1000,
+                        help='запросов в секунду на аккаунт (0 - как в main.py); по умолчанию '
+                             'лимит снят, чтобы мерить конвейер, а не token bucket')
+    parser.add_argument('--workers', type=int, default=1, help='воркеров анализа')
+    parser.add_argument('--worker-concurrency', type=int, default=4, help='задач одновременно в воркере')
+    parser.add_argument('--fetch-latency-ms', type=float, default=150, help='медиана задержки страницы истории')
+    parser.add_argument('--llm-latency-ms', type=float, default=3000, help='медиана задержки ответа провайдера')
+    parser.add_argument('--jitter', type=float, default=0.5, help='sigma логнормального распределения задержек')
+    parser.add_argument('--fetch-error-rate', type=float, default=0.0)
+    parser.add_argument('--llm-error-rate', type=float, default=0.1)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--startup-budget-ms', type=float, nargs='?', const=STARTUP_BUDGET_MS, default=None,
+                        help=f'только проверить время импорта main.py и выйти (без значения - {STARTUP_BUDGET_MS} мс)')
+    args = parser.parse_args()
+
+    if args.startup_budget_ms is not None:
+        sys.exit(0 if check_startup(args.startup_budget_ms) else 1)
+
+    # Работаем во временной папке, чтобы не трогать настоящие bot.db и user_data.json
+    workdir = tempfile.mkdtemp(prefix='suckfox_bench_')
+    os.environ.update(BENCH_ENV, LOG_FILE=os.path.join(workdir, 'bot.log'))
+    os.chdir(workdir)
+    sys.path.insert(0, REPO_DIR)
+    random.seed(args.seed)
+
+    import logging
+    import main
+    logging.getLogger().setLevel(logging.WARNING)
+    if args.account_rps:
+        main.ACCOUNT_REQUESTS_PER_SECOND = args.account_rps
+        main.ACCOUNT_BURST = max(main.ACCOUNT_BURST, math.ceil(args.account_rps))
+    main.client_pool = main.ClientPool([f"bench_{n}" for n in range(args.accounts)],
+                                       client_factory=lambda name: FakeTelegramClient(args))
+    fake_g4f = make_fake_g4f(args)
+    main.get_g4f = lambda: fake_g4f
+    main.bot = FakeBot()
+    main.WORKER_POLL_INTERVAL = 0.02
+
+    # Запоминаем ID задачи, поставленной для каждого чата
+    enqueue_job = main.enqueue_job
+
+    def enqueue_and_remember(kind, user_id, chat_id, payload):
+        job_id = enqueue_job(kind, user_id, chat_id, payload)
+        LATEST_JOB_IDS[chat_id] = job_id
+        return job_id
+
+    main.enqueue_job = enqueue_and_remember
+
+    async def run_all():
+        workers = [asyncio.ensure_future(main.worker_loop(f"bench{n}", args.worker_concurrency))
+                   for n in range(args.workers)]
+        results = [await run_scenario(main, args, int(size)) for size in args.sizes.split(',')]
+        for worker in workers:
+            worker.cancel()
+        await main.close_http_connector()
+        return results
+
+    results = asyncio.run(run_all())
+    print(f"{'каналов':>8} {'запусков':>8} {'ошибок':>7} {'run/s':>8} {'p50, с':>8} {'p99, с':>8} {'RSS, МБ':>8}")
+    for r in results:
+        print(f"{r['size']:>8} {r['runs']:>8} {r['failures']:>7} {r['throughput']:>8.2f} "
+              f"{r['p50']:>8.2f} {r['p99']:>8.2f} {r['rss']:>8.1f}")
+    print(f"Вызовов LLM: {fake_g4f.ChatCompletion.calls}")
+
+if __name__ == '__main__':
+    main_cli()
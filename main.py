@@ -1,8 +1,8 @@
 import os
 import json
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import asyncio
-import g4f
+import importlib
 import logging
 import re
 import sqlite3
@@ -14,40 +14,153 @@ from aiogram.contrib.fsm_storage.memory import MemoryStorage
 from aiogram.dispatcher import FSMContext
 from aiogram.dispatcher.filters.state import State, StatesGroup
 from dotenv import load_dotenv
-from telethon import TelegramClient
-from telethon.tl.functions.messages import GetHistoryRequest
-from telethon.tl.functions.channels import JoinChannelRequest
-from telethon.errors import ChannelPrivateError, UsernameNotOccupiedError
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 import random
-from fpdf import FPDF
-from reportlab.pdfgen import canvas
-from reportlab.pdfbase import pdfmetrics
-from reportlab.pdfbase.ttfonts import TTFont
-from reportlab.lib.pagesizes import A4
-from transliterate import translit
 import platform
+import time
+import uuid
+import queue
+import atexit
+import contextvars
+import logging.handlers
+import bisect
+import hashlib
+import sys
+import argparse
+import functools
+import math
+import copy
+import contextlib
+import threading
+import traceback
+import csv
+import gzip
+import io
+import zipfile
+
+# Тяжелые зависимости (g4f, telethon, reportlab) импортируются лениво,
+# при первом обращении, чтобы бот быстрее стартовал и перезапускался
+
+# Настройки логов: bot.log пишется в JSON с ротацией
+LOG_FILE = os.getenv('LOG_FILE', 'bot.log')
+LOG_MAX_BYTES = int(os.getenv('LOG_MAX_BYTES', str(10 * 1024 * 1024)))
+LOG_BACKUP_COUNT = int(os.getenv('LOG_BACKUP_COUNT', '5'))
+SECRET_ENV_VARS = ('BOT_TOKEN', 'API_HASH')
+BOT_TOKEN_RE = re.compile(r'\b\d{6,12}:[A-Za-z0-9_-]{30,}\b')
+
+# ID текущего запуска анализа, попадает во все записи лога
+current_run_id = contextvars.ContextVar('current_run_id', default=None)
+
+def redact_secrets(text: str) -> str:
+    for name in SECRET_ENV_VARS:
+        secret = os.getenv(name)
+        if secret and secret in text:
+            text = text.replace(secret, f'<{name}>')
+    return BOT_TOKEN_RE.sub('<BOT_TOKEN>', text)
+
+class RedactSecretsFilter(logging.Filter):
+    """Вырезаем токены и ключи из сообщений до того, как они попадут в лог"""
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.msg = redact_secrets(record.getMessage())
+        record.args = None
+        record.run_id = current_run_id.get()
+        return True
+
+class RecordQueueHandler(logging.handlers.QueueHandler):
+    """Стандартный QueueHandler.prepare (3.11) вклеивает traceback в msg и обнуляет exc_info:
+    JsonFormatter терял поле exc, а текст traceback не проходил очистку от секретов.
+    Здесь traceback форматируется в exc_text и чистится так же, как сообщение"""
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        if record.exc_info:
+            record.exc_text = redact_secrets(logging.Formatter().formatException(record.exc_info))
+            record.exc_info = None
+        if record.stack_info:
+            record.stack_info = redact_secrets(record.stack_info)
+        return record
+
+class JsonFormatter(logging.Formatter):
+    """Одна JSON запись на строку. Поля этапа (span) приходят словарем в record.fields"""
+    EXTRA_FIELDS = ('span', 'duration_ms', 'status')
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'ts': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        run_id = getattr(record, 'run_id', None)
+        if run_id:
+            entry['run_id'] = run_id
+        for field in self.EXTRA_FIELDS:
+            if hasattr(record, field):
+                entry[field] = getattr(record, field)
+        for field, value in getattr(record, 'fields', {}).items():
+            entry.setdefault(field, value)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+def process_log_file() -> str:
+    """Файл лога этого процесса. Воркеры (main.py --worker) пишут каждый в свой
+    bot.<worker_id>.log: ротировать один файл из нескольких процессов
+    RotatingFileHandler не умеет, и часть записей терялась бы"""
+    if '--worker' not in sys.argv:
+        return LOG_FILE
+    worker_id = f'w{os.getpid()}'
+    for i, arg in enumerate(sys.argv):
+        if arg == '--worker-id' and i + 1 < len(sys.argv):
+            worker_id = sys.argv[i + 1]
+        elif arg.startswith('--worker-id='):
+            worker_id = arg.split('=', 1)[1]
+    root, extension = os.path.splitext(LOG_FILE)
+    return f"{root}.{worker_id}{extension}"
+
+def setup_logging():
+    """Логи уходят в очередь, а на диск их пишет отдельный поток QueueListener,
+    чтобы запись в файл не блокировала event loop"""
+    file_handler = logging.handlers.RotatingFileHandler(
+        process_log_file(), maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding='utf-8'
+    )
+    file_handler.setFormatter(JsonFormatter())
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+    
+    log_queue = queue.Queue(-1)
+    queue_handler = RecordQueueHandler(log_queue)
+    queue_handler.addFilter(RedactSecretsFilter())
+    
+    root = logging.getLogger()
+    root.setLevel(logging.INFO)
+    root.handlers = [queue_handler]
+    
+    listener = logging.handlers.QueueListener(log_queue, file_handler, stream_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
 
 # Настраиваем логирование
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('bot.log'),
-        logging.StreamHandler()
-    ]
-)
+log_listener = setup_logging()
 logger = logging.getLogger(__name__)
 
 # Загружаем переменные окружения
 logger.info("Загружаем .env файл...")
 load_dotenv()
 token = os.getenv('BOT_TOKEN')
-logger.info(f"Токен: {token}")
+logger.info("Токен загружен" if token else "Токен не задан")
 
 if not token:
     raise ValueError("BOT_TOKEN не найден в .env файле!")
 
+def ensure_column(c, table: str, column: str, declaration: str):
+    """Добавляем колонку в существующую таблицу, если ее еще нет"""
+    c.execute(f'PRAGMA table_info({table})')
+    if column not in [row[1] for row in c.fetchall()]:
+        c.execute(f'ALTER TABLE {table} ADD COLUMN {column} {declaration}')
+
 # Инициализируем SQLite
 def init_db():
     conn = sqlite3.connect('bot.db')
@@ -60,6 +173,9 @@ def init_db():
                   folder TEXT,
                   content TEXT,
                   created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+    # Дата самого нового поста, вошедшего в отчет (для дельта-анализа)
+    ensure_column(c, 'reports', 'cutoff', 'TIMESTAMP')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_reports_user ON reports (user_id, created_at)')
     
     # Таблица для расписания
     c.execute('''CREATE TABLE IF NOT EXISTS schedules
@@ -69,110 +185,906 @@ def init_db():
                   time TEXT,
                   is_active BOOLEAN DEFAULT 1)''')
     
+    # Очередь задач анализа: хендлеры только ставят задачи, выполняют их воркеры
+    c.execute('''CREATE TABLE IF NOT EXISTS jobs
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  kind TEXT,
+                  user_id INTEGER,
+                  chat_id INTEGER,
+                  payload TEXT,
+                  status TEXT DEFAULT 'queued',
+                  worker TEXT,
+                  attempts INTEGER DEFAULT 0,
+                  error TEXT,
+                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                  started_at TIMESTAMP,
+                  heartbeat_at TIMESTAMP,
+                  finished_at TIMESTAMP)''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, id)')
+    # Дедлайн (unix time) ставится при первом запуске задачи и сохраняется для повторов
+    ensure_column(c, 'jobs', 'deadline', 'REAL')
+    
+    # Чекпоинты задач: после рестарта задача продолжается с последнего готового этапа
+    c.execute('''CREATE TABLE IF NOT EXISTS job_checkpoints
+                 (job_id INTEGER,
+                  stage TEXT,
+                  key TEXT,
+                  data TEXT,
+                  PRIMARY KEY (job_id, stage, key))''')
+    
+    # Выгруженные посты каналов (для длинных окон анализа)
+    c.execute('''CREATE TABLE IF NOT EXISTS channel_posts
+                 (channel TEXT,
+                  id INTEGER,
+                  date TIMESTAMP,
+                  text TEXT,
+                  PRIMARY KEY (channel, id))''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_channel_posts_date ON channel_posts (channel, date)')
+    
+    # Буфер фонового получения постов, которым процесс с событиями делится с воркерами:
+    # посты лежат в channel_posts, здесь - с какого момента они полные и когда сверялись с историей
+    c.execute('''CREATE TABLE IF NOT EXISTS ingest_channels
+                 (channel TEXT PRIMARY KEY,
+                  covered_since TIMESTAMP,
+                  synced_at REAL)''')
+    
+    # Прогресс выгрузки истории по диапазонам дат: позволяет продолжить после рестарта
+    c.execute('''CREATE TABLE IF NOT EXISTS backfill_partitions
+                 (channel TEXT,
+                  part_start TIMESTAMP,
+                  part_end TIMESTAMP,
+                  oldest_id INTEGER,
+                  done BOOLEAN DEFAULT 0,
+                  PRIMARY KEY (channel, part_start, part_end))''')
+    
+    # Общие выжимки по каналам: считаются один раз и переиспользуются всеми папками
+    c.execute('''CREATE TABLE IF NOT EXISTS channel_digests
+                 (channel TEXT,
+                  window_hours INTEGER,
+                  last_post_id INTEGER,
+                  post_count INTEGER,
+                  digest TEXT,
+                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                  PRIMARY KEY (channel, window_hours))''')
+    
+    # file_id отправленных файлов отчетов: повторно файл уходит без генерации и загрузки
+    c.execute('''CREATE TABLE IF NOT EXISTS report_files
+                 (report_id INTEGER,
+                  format TEXT,
+                  file_id TEXT,
+                  PRIMARY KEY (report_id, format))''')
+    
+    # WAL позволяет фронтенду и воркерам писать в базу параллельно
+    c.execute('PRAGMA journal_mode=WAL')
+    
+    init_search_index(c)
+    
     conn.commit()
     conn.close()
 
+# Полнотекстовый поиск (/search): FTS5-индексы поверх reports и channel_posts.
+# Индексы хранят только токены (external content), текст берется из самих таблиц,
+# а триггеры поддерживают их в актуальном состоянии
+FTS_TABLES = {
+    'reports_fts': ('reports', 'id', ('folder', 'content')),
+    'channel_posts_fts': ('channel_posts', 'rowid', ('text',)),
+}
+search_enabled = False
+
+def init_search_index(c):
+    global search_enabled
+    try:
+        for fts, (table, rowid, columns) in FTS_TABLES.items():
+            c.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (fts,))
+            created = c.fetchone() is None
+            cols = ', '.join(columns)
+            new_cols = ', '.join(f'new.{col}' for col in columns)
+            old_cols = ', '.join(f'old.{col}' for col in columns)
+            c.execute(f'''CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5
+                          ({cols}, content='{table}', content_rowid='{rowid}',
+                           tokenize='unicode61 remove_diacritics 2')''')
+            c.execute(f'''CREATE TRIGGER IF NOT EXISTS {fts}_ai AFTER INSERT ON {table} BEGIN
+                            INSERT INTO {fts} (rowid, {cols}) VALUES (new.{rowid}, {new_cols});
+                          END''')
+            c.execute(f'''CREATE TRIGGER IF NOT EXISTS {fts}_ad AFTER DELETE ON {table} BEGIN
+                            INSERT INTO {fts} ({fts}, rowid, {cols}) VALUES ('delete', old.{rowid}, {old_cols});
+                          END''')
+            c.execute(f'''CREATE TRIGGER IF NOT EXISTS {fts}_au AFTER UPDATE ON {table} BEGIN
+                            INSERT INTO {fts} ({fts}, rowid, {cols}) VALUES ('delete', old.{rowid}, {old_cols});
+                            INSERT INTO {fts} (rowid, {cols}) VALUES (new.{rowid}, {new_cols});
+                          END''')
+            if created:
+                # Индексируем строки, сохраненные до появления поиска
+                c.execute(f"INSERT INTO {fts} ({fts}) VALUES ('rebuild')")
+        search_enabled = True
+    except sqlite3.OperationalError as e:
+        logger.warning(f"SQLite собран без FTS5, поиск отключен: {str(e)}")
+
 init_db()
 
 # Создаем планировщик (но не запускаем)
 scheduler = AsyncIOScheduler(timezone=pytz.UTC)
 
-# Конфигурация провайдеров и моделей
+# Метрики в формате Prometheus (отдаются на /metrics, см. start_metrics_server)
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9108'))  # 0 - не поднимать сервер
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+def _format_labels(names: tuple, values: tuple, extra: str = '') -> str:
+    """Собираем строку меток вида {a="1",b="2"}"""
+    pairs = [f'{name}="{str(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+class Metric:
+    """Базовая метрика с метками"""
+    kind = 'untyped'
+    registry = []
+
+    def __init__(self, name: str, help_text: str, labels: tuple = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.values = {}
+        Metric.registry.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(labels.get(name, '') for name in self.labels)
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        for key, value in sorted(self.values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labels, key)} {value}")
+        return lines
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value: float, **labels):
+        self.values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, help_text: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = buckets
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        state = self.values.setdefault(key, {'counts': [0] * len(self.buckets), 'sum': 0.0, 'count': 0})
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                state['counts'][i] += 1
+        state['sum'] += value
+        state['count'] += 1
+
+    def time(self, **labels):
+        """Контекстный менеджер, замеряющий длительность блока"""
+        return _Timer(self, labels)
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        for key, state in sorted(self.values.items()):
+            for bound, count in zip(self.buckets, state['counts']):
+                bucket_labels = _format_labels(self.labels, key, 'le="%s"' % bound)
+                lines.append(f"{self.name}_bucket{bucket_labels} {count}")
+            inf_labels = _format_labels(self.labels, key, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{inf_labels} {state['count']}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {state['sum']}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {state['count']}")
+        return lines
+
+class _Timer:
+    def __init__(self, histogram: Histogram, labels: dict):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+        return False
+
+CHANNEL_FETCH_SECONDS = Histogram('suckfox_channel_fetch_seconds', 'Время получения постов одного канала')
+LLM_REQUEST_SECONDS = Histogram('suckfox_llm_request_seconds', 'Время запроса к провайдеру ИИ', ('provider', 'status'))
+LLM_FAILURES = Counter('suckfox_llm_failures_total', 'Ошибки провайдеров ИИ по причинам', ('provider', 'cause'))
+RENDER_SECONDS = Histogram('suckfox_render_seconds', 'Время генерации файла отчета', ('format',))
+UPLOAD_SECONDS = Histogram('suckfox_upload_seconds', 'Время отправки файла отчета в Telegram')
+STAGE_SECONDS = Histogram('suckfox_analysis_stage_seconds', 'Время этапов анализа папки', ('stage',))
+QUEUE_DEPTH = Gauge('suckfox_analysis_queue_depth', 'Сколько задач анализа ждет в очереди')
+JOBS_TOTAL = Counter('suckfox_jobs_total', 'Выполненные задачи анализа', ('kind', 'status'))
+CACHE_HITS = Counter('suckfox_cache_hits_total', 'Попадания в кэши', ('cache',))
+CACHE_MISSES = Counter('suckfox_cache_misses_total', 'Промахи мимо кэшей', ('cache',))
+FLOOD_WAITS = Counter('suckfox_floodwait_total', 'Полученные FloodWait от Telegram', ('account',))
+FLOOD_WAIT_SECONDS = Counter('suckfox_floodwait_seconds_total', 'Суммарное время FloodWait', ('account',))
+POST_CHARS = Counter('suckfox_post_chars_total', 'Символы постов до и после нормализации', ('stage',))
+LOOP_LAG_SECONDS = Histogram('suckfox_event_loop_lag_seconds', 'Задержка цикла событий asyncio',
+                             buckets=(0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10))
+LOOP_BLOCKS = Counter('suckfox_event_loop_blocks_total', 'Блокировки цикла событий дольше порога')
+BOT_RETRY_AFTER = Counter('suckfox_bot_retry_after_total', 'Полученные RetryAfter от Bot API', ('method',))
+
+def classify_llm_error(error_str: str) -> str:
+    """Определяем причину ошибки провайдера для метрик"""
+    lowered = error_str.lower()
+    if "429" in error_str or "ERR_INPUT_LIMIT" in error_str:
+        return 'rate_limit'
+    if 'timeout' in lowered or 'timed out' in lowered:
+        return 'timeout'
+    if 'пустой ответ' in lowered:
+        return 'empty'
+    if 'connect' in lowered or 'ssl' in lowered:
+        return 'network'
+    return 'error'
+
+def new_run_id() -> str:
+    """Начинаем новый запуск анализа: все логи в этом контексте получат его ID"""
+    run_id = uuid.uuid4().hex[:12]
+    current_run_id.set(run_id)
+    return run_id
+
+# Бюджет времени на анализ: хендлер кладет в задачу длительность, при первом запуске
+# задачи она превращается в дедлайн (unix time, хранится в jobs.deadline), воркер
+# выставляет его в контекст, и сбор постов, запросы к ИИ и генерация файлов
+# укладываются в оставшееся время
+ANALYSIS_BUDGET_SECONDS = int(os.getenv('ANALYSIS_BUDGET_SECONDS', '600'))
+SCHEDULED_BUDGET_SECONDS = int(os.getenv('SCHEDULED_BUDGET_SECONDS', '1800'))
+DEADLINE_LLM_RESERVE = float(os.getenv('DEADLINE_LLM_RESERVE', '45'))  # сбор постов оставляет это время на ИИ
+current_deadline = contextvars.ContextVar('current_deadline', default=None)
+
+class DeadlineExceeded(Exception):
+    """Бюджет времени анализа исчерпан"""
+
+def time_left():
+    """Сколько секунд осталось до дедлайна текущей задачи (None - без дедлайна)"""
+    deadline = current_deadline.get()
+    return None if deadline is None else deadline - time.time()
+
+def check_deadline(stage: str, reserve: float = 0):
+    left = time_left()
+    if left is not None and left <= reserve:
+        raise DeadlineExceeded(f"Бюджет времени исчерпан ({stage})")
+
+async def within_deadline(coro, stage: str, reserve: float = 0):
+    """Ждем корутину не дольше, чем осталось до дедлайна минус reserve"""
+    left = time_left()
+    if left is None:
+        return await coro
+    if left <= reserve:
+        coro.close()
+        raise DeadlineExceeded(f"Бюджет времени исчерпан ({stage})")
+    try:
+        return await asyncio.wait_for(coro, left - reserve)
+    except asyncio.TimeoutError:
+        raise DeadlineExceeded(f"Бюджет времени исчерпан ({stage})")
+
+class span:
+    """Замеряет этап анализа: пишет длительность в лог и в метрику STAGE_SECONDS"""
+    def __init__(self, name: str, **fields):
+        self.name = name
+        self.fields = fields
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        duration = time.perf_counter() - self.start
+        STAGE_SECONDS.observe(duration, stage=self.name)
+        logger.info(
+            f"Этап {self.name} занял {duration * 1000:.0f} мс",
+            extra={'span': self.name, 'duration_ms': round(duration * 1000, 1),
+                   'status': 'error' if exc_type else 'ok', 'fields': self.fields}
+        )
+        return False
+
+def render_metrics() -> str:
+    """Выгружаем все метрики в текстовом формате Prometheus"""
+    lines = []
+    for metric in Metric.registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+async def start_metrics_server():
+    """Поднимаем локальный HTTP сервер с /metrics"""
+    if not METRICS_PORT:
+        return None
+    from aiohttp import web
+
+    async def handle_metrics(request):
+        return web.Response(text=render_metrics(), content_type='text/plain', charset='utf-8')
+
+    app = web.Application()
+    app.router.add_get('/metrics', handle_metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    logger.info(f"Метрики доступны на http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    return runner
+
+# Сторож цикла событий: корутина отмечается каждые LOOP_LAG_INTERVAL секунд, а отдельный
+# поток, если отметки нет дольше LOOP_BLOCK_THRESHOLD, пишет в лог стек потока цикла -
+# то есть синхронный код, который его сейчас держит (sqlite, рендер PDF, работа с файлами)
+LOOP_WATCHDOG = os.getenv('LOOP_WATCHDOG', '1') == '1'
+LOOP_LAG_INTERVAL = float(os.getenv('LOOP_LAG_INTERVAL', '0.5'))
+LOOP_BLOCK_THRESHOLD = float(os.getenv('LOOP_BLOCK_THRESHOLD', '1.0'))
+
+class LoopWatchdog:
+    def __init__(self, interval: float, threshold: float):
+        self.interval = interval
+        self.threshold = threshold
+        self.last_beat = time.monotonic()
+        self.loop_thread_id = None
+        self.stopped = threading.Event()
+
+    async def run(self):
+        """Отметки из цикла событий; поток-сторож живет, пока работает эта корутина"""
+        self.loop_thread_id = threading.get_ident()
+        self.last_beat = time.monotonic()
+        threading.Thread(target=self._watch, name='loop-watchdog', daemon=True).start()
+        try:
+            while True:
+                started = time.monotonic()
+                await asyncio.sleep(self.interval)
+                self.last_beat = time.monotonic()
+                LOOP_LAG_SECONDS.observe(max(0.0, self.last_beat - started - self.interval))
+        finally:
+            self.stopped.set()
+
+    def _watch(self):
+        reported = None
+        while not self.stopped.wait(self.interval / 2):
+            beat = self.last_beat
+            blocked = time.monotonic() - beat - self.interval
+            if blocked < self.threshold or reported == beat:
+                continue
+            # Об одной блокировке пишем один раз
+            reported = beat
+            LOOP_BLOCKS.inc()
+            frame = sys._current_frames().get(self.loop_thread_id)
+            stack = ''.join(traceback.format_stack(frame)) if frame is not None else 'стек недоступен\n'
+            logger.warning(f"Цикл событий заблокирован уже {blocked:.2f} с, сейчас выполняется:\n{stack.rstrip()}")
+
+def start_loop_watchdog(tasks: list):
+    if LOOP_WATCHDOG:
+        tasks.append(asyncio.ensure_future(LoopWatchdog(LOOP_LAG_INTERVAL, LOOP_BLOCK_THRESHOLD).run()))
+
+# Семплирующий профайлер для /profile: раз в PROFILE_INTERVAL снимаем стеки всех потоков
+# через sys._current_frames и считаем одинаковые стеки. Результат - collapsed stacks
+# ("поток;файл:функция;... число"), их понимают flamegraph.pl и speedscope
+PROFILE_INTERVAL = float(os.getenv('PROFILE_INTERVAL', '0.01'))
+PROFILE_MAX_SECONDS = int(os.getenv('PROFILE_MAX_SECONDS', '120'))
+profile_lock = threading.Lock()
+
+def sample_stacks(seconds: float, interval: float = PROFILE_INTERVAL) -> dict:
+    """Семплируем стеки всех потоков, кроме своего: {collapsed-стек: число семплов}"""
+    own_id = threading.get_ident()
+    names = {}
+    counts = {}
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_id:
+                continue
+            if thread_id not in names:
+                names = {thread.ident: thread.name for thread in threading.enumerate()}
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                frame = frame.f_back
+            stack.append(names.get(thread_id, str(thread_id)))
+            key = ';'.join(reversed(stack))
+            counts[key] = counts.get(key, 0) + 1
+        time.sleep(interval)
+    return counts
+
+def write_collapsed_stacks(counts: dict) -> str:
+    filename = f"profile_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt"
+    with open(filename, 'w', encoding='utf-8') as f:
+        for stack, count in sorted(counts.items(), key=lambda item: -item[1]):
+            f.write(f"{stack} {count}\n")
+    return filename
+
+def get_g4f():
+    """Лениво импортируем g4f при первом запросе к ИИ"""
+    return importlib.import_module('g4f')
+
+_provider_cache = {}
+
+def get_provider(name: str):
+    """Получаем класс провайдера g4f по имени (с кэшированием)"""
+    if name not in _provider_cache:
+        _provider_cache[name] = getattr(get_g4f().Provider, name)
+    return _provider_cache[name]
+
+# Конфигурация провайдеров и моделей (провайдеры указаны по имени и
+# резолвятся через get_provider только когда действительно нужны)
 PROVIDER_HIERARCHY = [
     {
-        'provider': g4f.Provider.DDG,
+        'provider': 'DDG',
         'models': ['gpt-4', 'gpt-4o-mini', 'claude-3-haiku', 'llama-3.1-70b', 'mixtral-8x7b']
     },
     {
-        'provider': g4f.Provider.Blackbox,
+        'provider': 'Blackbox',
         'models': ['blackboxai', 'gpt-4', 'gpt-4o', 'o3-mini', 'gemini-1.5-flash', 'gemini-1.5-pro', 
                   'blackboxai-pro', 'llama-3.1-8b', 'llama-3.1-70b', 'llama-3.1-405b', 'llama-3.3-70b', 
                   'mixtral-small-28b', 'deepseek-chat', 'dbrx-instruct', 'qwq-32b', 'hermes-2-dpo', 'deepseek-r1']
     },
     {
-        'provider': g4f.Provider.DeepInfraChat,
+        'provider': 'DeepInfraChat',
         'models': ['llama-3.1-8b', 'llama-3.2-90b', 'llama-3.3-70b', 'deepseek-v3', 'mixtral-small-28b',
                   'deepseek-r1', 'phi-4', 'wizardlm-2-8x22b', 'qwen-2.5-72b', 'yi-34b', 'qwen-2-72b',
                   'dolphin-2.6', 'dolphin-2.9', 'dbrx-instruct', 'airoboros-70b', 'lzlv-70b', 'wizardlm-2-7b']
     },
     {
-        'provider': g4f.Provider.ChatGptEs,
+        'provider': 'ChatGptEs',
         'models': ['gpt-4', 'gpt-4o', 'gpt-4o-mini']
     },
     {
-        'provider': g4f.Provider.Liaobots,
+        'provider': 'Liaobots',
         'models': ['grok-2', 'gpt-4o-mini', 'gpt-4o', 'gpt-4', 'o1-preview', 'o1-mini', 'deepseek-r1',
                   'deepseek-v3', 'claude-3-opus', 'claude-3.5-sonnet', 'claude-3-sonnet', 'gemini-1.5-flash',
                   'gemini-1.5-pro', 'gemini-2.0-flash', 'gemini-2.0-flash-thinking']
     },
     {
-        'provider': g4f.Provider.Jmuz,
+        'provider': 'Jmuz',
         'models': ['gpt-4', 'gpt-4o', 'gpt-4o-mini', 'llama-3-8b', 'llama-3-70b', 'llama-3.1-8b', 
                   'llama-3.1-70b', 'llama-3.1-405b', 'llama-3.2-11b', 'llama-3.2-90b', 'llama-3.3-70b',
                   'claude-3-haiku', 'claude-3-sonnet', 'claude-3-opus', 'claude-3.5-sonnet', 
                   'gemini-1.5-flash', 'gemini-1.5-pro', 'gemini-exp', 'deepseek-chat', 'deepseek-r1', 'qwq-32b']
     },
     {
-        'provider': g4f.Provider.Glider,
+        'provider': 'Glider',
         'models': ['llama-3.1-8b', 'llama-3.1-70b', 'llama-3.2-3b', 'deepseek-r1']
     },
     {
-        'provider': g4f.Provider.PollinationsAI,
+        'provider': 'PollinationsAI',
         'models': ['gpt-4o', 'gpt-4o-mini', 'llama-3.1-8b', 'llama-3.3-70b', 'deepseek-chat', 
                   'deepseek-r1', 'qwen-2.5-coder-32b', 'gemini-2.0-flash', 'evil', 'flux-pro']
     },
     {
-        'provider': g4f.Provider.HuggingChat,
+        'provider': 'HuggingChat',
         'models': ['llama-3.2-11b', 'llama-3.3-70b', 'mistral-nemo', 'phi-3.5-mini', 'deepseek-r1',
                   'qwen-2.5-coder-32b', 'qwq-32b', 'nemotron-70b']
     },
     {
-        'provider': g4f.Provider.HuggingFace,
+        'provider': 'HuggingFace',
         'models': ['llama-3.2-11b', 'llama-3.3-70b', 'mistral-nemo', 'deepseek-r1', 
                   'qwen-2.5-coder-32b', 'qwq-32b', 'nemotron-70b']
     },
     {
-        'provider': g4f.Provider.HuggingSpace,
+        'provider': 'HuggingSpace',
         'models': ['command-r', 'command-r-plus', 'command-r7b', 'qwen-2-72b', 'qwen-2.5-1m', 
                   'qvq-72b', 'sd-3.5', 'flux-dev', 'flux-schnell']
     },
     {
-        'provider': g4f.Provider.Cloudflare,
+        'provider': 'Cloudflare',
         'models': ['llama-2-7b', 'llama-3-8b', 'llama-3.1-8b', 'qwen-1.5-7b']
     },
     {
-        'provider': g4f.Provider.ChatGLM,
+        'provider': 'ChatGLM',
         'models': ['glm-4']
     },
     {
-        'provider': g4f.Provider.GigaChat,
+        'provider': 'GigaChat',
         'models': ['GigaChat:latest']
     },
     {
-        'provider': g4f.Provider.Gemini,
+        'provider': 'Gemini',
         'models': ['gemini', 'gemini-1.5-flash', 'gemini-1.5-pro']
     },
     {
-        'provider': g4f.Provider.GeminiPro,
+        'provider': 'GeminiPro',
         'models': ['gemini-1.5-flash', 'gemini-1.5-pro', 'gemini-2.0-flash']
     },
     {
-        'provider': g4f.Provider.Pi,
+        'provider': 'Pi',
         'models': ['pi']
     },
     {
-        'provider': g4f.Provider.PerplexityLabs,
+        'provider': 'PerplexityLabs',
         'models': ['sonar', 'sonar-pro', 'sonar-reasoning', 'sonar-reasoning-pro']
     }
 ]
 
+# Модели, которые у разных провайдеров называются по-разному, но это одна модель
+MODEL_EQUIVALENTS = [
+    {'deepseek-chat', 'deepseek-v3'},
+    {'gemini', 'gemini-1.5-pro'},
+]
+
+def model_family(model: str) -> str:
+    """Семейство модели: gpt-4o-mini -> gpt, llama-3.1-70b -> llama"""
+    match = re.match(r'[a-z]+', model.lower())
+    return match.group(0) if match else model.lower()
+
+def build_model_catalog() -> dict:
+    """Один раз строим индексы по PROVIDER_HIERARCHY: модель -> провайдеры, классы, семейства"""
+    providers_by_model = {}
+    for index, provider_info in enumerate(PROVIDER_HIERARCHY):
+        for model in provider_info['models']:
+            providers_by_model.setdefault(model, []).append(index)
+    
+    equivalents = {model: {model} for model in providers_by_model}
+    for group in MODEL_EQUIVALENTS:
+        for model in group:
+            equivalents[model] = set(group)
+    
+    families = {}
+    for model in providers_by_model:
+        families.setdefault(model_family(model), []).append(model)
+    
+    # Плоский список (провайдер, модель) для кнопок: по индексу строится короткий callback
+    choices = [(index, model) for index, provider_info in enumerate(PROVIDER_HIERARCHY)
+               for model in provider_info['models']]
+    return {
+        'providers_by_model': providers_by_model,
+        'provider_models': [set(provider_info['models']) for provider_info in PROVIDER_HIERARCHY],
+        'equivalents': equivalents,
+        'families': families,
+        'choices': choices,
+        'choice_index': {choice: i for i, choice in enumerate(choices)},
+    }
+
+MODEL_CATALOG = build_model_catalog()
+
+def provider_fallback_chain(model: str, preferred_index: int = None) -> list:
+    """Порядок перебора [(индекс провайдера, модель)]: сначала та же модель у других
+    провайдеров, потом эквивалентная, потом модель того же семейства, потом остальные"""
+    chain = []
+    used = set()
+    
+    def add_tier(candidates: list):
+        # DDG (индекс 0) и выбранный пользователем провайдер первыми, остальные вперемешку
+        head = [c for c in candidates if c[0] == preferred_index]
+        head += [c for c in candidates if c[0] == 0 and c[0] != preferred_index]
+        rest = [c for c in candidates if c[0] not in (0, preferred_index)]
+        random.shuffle(rest)
+        for provider_index, provider_model in head + rest:
+            if provider_index not in used:
+                used.add(provider_index)
+                chain.append((provider_index, provider_model))
+    
+    catalog = MODEL_CATALOG
+    add_tier([(index, model) for index in catalog['providers_by_model'].get(model, [])])
+    
+    equivalent = []
+    for other in sorted(catalog['equivalents'].get(model, set()) - {model}):
+        equivalent.extend((index, other) for index in catalog['providers_by_model'][other])
+    add_tier(equivalent)
+    
+    family = []
+    for index, provider_info in enumerate(PROVIDER_HIERARCHY):
+        same_family = [m for m in provider_info['models'] if model_family(m) == model_family(model)]
+        if same_family:
+            family.append((index, same_family[0]))
+    add_tier(family)
+    
+    add_tier([(index, provider_info['models'][0]) for index, provider_info in enumerate(PROVIDER_HIERARCHY)])
+    return chain
+
+MODELS_PAGE_SIZE = 10
+
+@functools.lru_cache(maxsize=256)
+def build_models_keyboard(page: int, selected: int):
+    """Страница клавиатуры выбора модели (кэшируется по странице и выбранной модели)"""
+    choices = MODEL_CATALOG['choices']
+    pages = (len(choices) + MODELS_PAGE_SIZE - 1) // MODELS_PAGE_SIZE
+    keyboard = types.InlineKeyboardMarkup(row_width=3)
+    for i in range(page * MODELS_PAGE_SIZE, min(len(choices), (page + 1) * MODELS_PAGE_SIZE)):
+        provider_index, model = choices[i]
+        keyboard.row(types.InlineKeyboardButton(
+            f"{'✅ ' if i == selected else ''}{model} ({PROVIDER_HIERARCHY[provider_index]['provider']})",
+            callback_data=f"m:{i}"
+        ))
+    navigation = []
+    if page > 0:
+        navigation.append(types.InlineKeyboardButton("⬅️", callback_data=f"mp:{page - 1}"))
+    # Счетчик страниц ничего не меняет: повторная отправка той же клавиатуры дала бы MessageNotModified
+    navigation.append(types.InlineKeyboardButton(f"{page + 1}/{pages}", callback_data="noop"))
+    if page < pages - 1:
+        navigation.append(types.InlineKeyboardButton("➡️", callback_data=f"mp:{page + 1}"))
+    keyboard.row(*navigation)
+    return keyboard
+
+# Общий пул HTTP соединений для g4f и Bot API: keep-alive, лимиты на хост, кэш DNS
+HTTP_LIMIT = int(os.getenv('HTTP_LIMIT', '100'))
+HTTP_LIMIT_PER_HOST = int(os.getenv('HTTP_LIMIT_PER_HOST', '10'))
+HTTP_DNS_TTL = int(os.getenv('HTTP_DNS_TTL', '300'))
+HTTP_KEEPALIVE = float(os.getenv('HTTP_KEEPALIVE', '30'))
+
+http_connector = None
+
+def get_http_connector():
+    """Общий коннектор aiohttp. Провайдеры g4f открывают свои ClientSession и
+    при выходе закрывают коннектор, поэтому close() у него ничего не делает,
+    а закрывается он только в close_http_connector()"""
+    global http_connector
+    if http_connector is None or http_connector.closed:
+        import aiohttp
+
+        class SharedConnector(aiohttp.TCPConnector):
+            def close(self):
+                done = asyncio.get_event_loop().create_future()
+                done.set_result(None)
+                return done
+
+            async def shutdown(self):
+                await super().close()
+
+        http_connector = SharedConnector(limit=HTTP_LIMIT, limit_per_host=HTTP_LIMIT_PER_HOST,
+                                         ttl_dns_cache=HTTP_DNS_TTL, keepalive_timeout=HTTP_KEEPALIVE)
+    return http_connector
+
+def attach_bot_session():
+    """Переводим Bot на общий коннектор"""
+    import aiohttp
+    from aiogram.utils import json as aiogram_json
+    bot._session = aiohttp.ClientSession(connector=get_http_connector(), connector_owner=False,
+                                         json_serialize=aiogram_json.dumps)
+
+async def close_http_connector():
+    """Закрываем сессию бота и общий коннектор"""
+    global http_connector
+    session = getattr(bot, '_session', None)
+    if session is not None and not session.closed:
+        await session.close()
+    if http_connector is not None and not http_connector.closed:
+        await http_connector.shutdown()
+    http_connector = None
+
 # Инициализируем клиенты
 bot = Bot(token=token)
 storage = MemoryStorage()
 dp = Dispatcher(bot, storage=storage)
 
-# Инициализируем клиент Telethon
-client = TelegramClient('telegram_session', int(os.getenv('API_ID')), os.getenv('API_HASH'))
+# Пул аккаунтов Telethon для чтения каналов. Первая сессия - основная
+# (для нее при необходимости запрашивается вход), остальные подключаются,
+# только если уже авторизованы
+TELETHON_SESSIONS = [name.strip() for name in os.getenv('TELETHON_SESSIONS', 'telegram_session').split(',') if name.strip()]
+# Бюджет запросов на аккаунт в каждом процессе: один токен - одна выгрузка канала (страница истории).
+# Он задает потолок скорости чтения: при 5 в секунду папка из 500 каналов читается одним
+# аккаунтом ~100 с, при 1 в секунду - ~500 с, почти весь бюджет анализа (ANALYSIS_BUDGET_SECONDS)
+ACCOUNT_REQUESTS_PER_SECOND = float(os.getenv('ACCOUNT_REQUESTS_PER_SECOND', '5'))
+ACCOUNT_BURST = int(os.getenv('ACCOUNT_BURST', '20'))
+POOL_MAX_FLOOD_WAIT = int(os.getenv('POOL_MAX_FLOOD_WAIT', '30'))  # сколько готовы ждать, если в FloodWait все
+
+class TokenBucket:
+    """Простой token bucket: rate токенов в секунду, не больше capacity"""
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, tokens: float = 1) -> float:
+        """Сколько секунд ждать, пока наберется tokens токенов"""
+        self._refill()
+        if self.tokens >= tokens:
+            return 0.0
+        return (tokens - self.tokens) / self.rate
+
+    async def acquire(self, tokens: float = 1):
+        while True:
+            wait = self.delay(tokens)
+            if wait <= 0:
+                self.tokens -= tokens
+                return
+            await asyncio.sleep(wait)
+
+class PoolAccount:
+    """Аккаунт пула: клиент, бюджет запросов и время окончания FloodWait"""
+    def __init__(self, name: str, client):
+        self.name = name
+        self.client = client
+        self.bucket = TokenBucket(ACCOUNT_REQUESTS_PER_SECOND, ACCOUNT_BURST)
+        self.blocked_until = 0.0
+        self.authorized = True
+
+    def blocked_for(self) -> float:
+        return max(0.0, self.blocked_until - time.monotonic())
+
+def create_telethon_client(session_name: str):
+    """Создаем клиент Telethon для сессии"""
+    from telethon import TelegramClient
+    # FloodWait обрабатывает пул (переключается на другой аккаунт), а не сам клиент
+    return TelegramClient(session_name, int(os.getenv('API_ID')), os.getenv('API_HASH'),
+                          flood_sleep_threshold=0)
+
+class ClientPool:
+    """Пул аккаунтов: каналы распределяются по аккаунтам консистентным хешированием"""
+    REPLICAS = 64
+
+    def __init__(self, session_names: list, client_factory=create_telethon_client):
+        self.accounts = [PoolAccount(name, client_factory(name)) for name in session_names]
+        self.ring = []
+        for index, account in enumerate(self.accounts):
+            for replica in range(self.REPLICAS):
+                self.ring.append((self._hash(f"{account.name}#{replica}"), index))
+        self.ring.sort()
+        self.ring_keys = [key for key, _ in self.ring]
+
+    @staticmethod
+    def _hash(value: str) -> int:
+        return int(hashlib.md5(value.encode('utf-8')).hexdigest()[:16], 16)
+
+    @property
+    def primary(self) -> PoolAccount:
+        return self.accounts[0]
+
+    def candidates(self, channel: str) -> list:
+        """Аккаунты в порядке обхода кольца начиная с позиции канала"""
+        start = bisect.bisect(self.ring_keys, self._hash(channel.lower()))
+        result = []
+        for offset in range(len(self.ring)):
+            index = self.ring[(start + offset) % len(self.ring)][1]
+            if index not in result:
+                result.append(index)
+                if len(result) == len(self.accounts):
+                    break
+        return [self.accounts[index] for index in result]
+
+    async def acquire(self, channel: str, exclude: set = ()):
+        """Выбираем аккаунт для канала, обходя аккаунты в FloodWait.
+        Аккаунты из exclude (уже словившие FloodWait на этом канале) берем, только если других нет"""
+        candidates = [account for account in self.candidates(channel) if account.authorized]
+        if not candidates:
+            return None
+        for account in candidates:
+            if account.name not in exclude and account.blocked_for() == 0:
+                await account.bucket.acquire()
+                return account
+        # Все в FloodWait или уже пробовали - ждем ближайший, если это недолго
+        account = min(candidates, key=lambda acc: acc.blocked_for())
+        if account.blocked_for() > POOL_MAX_FLOOD_WAIT:
+            return None
+        await asyncio.sleep(account.blocked_for())
+        await account.bucket.acquire()
+        return account
+
+    def report_flood(self, account: PoolAccount, seconds: int):
+        account.blocked_until = time.monotonic() + seconds
+        logger.warning(f"Аккаунт {account.name} в FloodWait на {seconds} сек")
+
+    async def start(self, interactive: bool = True):
+        """Запускаем основной аккаунт и подключаем остальные авторизованные"""
+        if interactive:
+            await self.primary.client.start()
+        for account in self.accounts[1 if interactive else 0:]:
+            try:
+                await account.client.connect()
+                account.authorized = await account.client.is_user_authorized()
+            except Exception as e:
+                logger.error(f"Не удалось подключить аккаунт {account.name}: {str(e)}")
+                account.authorized = False
+            if not account.authorized:
+                logger.warning(f"Сессия {account.name} не авторизована и не будет использоваться")
+        active = [account.name for account in self.accounts if account.authorized]
+        logger.info(f"Пул аккаунтов Telethon: {', '.join(active)}")
+
+    async def disconnect(self):
+        for account in self.accounts:
+            try:
+                await account.client.disconnect()
+            except Exception as e:
+                logger.warning(f"Ошибка при отключении аккаунта {account.name}: {str(e)}")
+
+def create_worker_telethon_client(session_name: str):
+    """Клиент для процесса-воркера: несколько процессов не могут писать в один
+    .session файл, поэтому воркер работает с копией ключа в памяти"""
+    from telethon import TelegramClient
+    from telethon.sessions import SQLiteSession, StringSession
+    session = SQLiteSession(session_name)
+    string = StringSession.save(session)
+    session.close()
+    return TelegramClient(StringSession(string), int(os.getenv('API_ID')), os.getenv('API_HASH'),
+                          flood_sleep_threshold=0)
+
+# Пул создается лениво в get_client_pool()
+client_pool = None
+
+def get_client_pool() -> ClientPool:
+    """Получаем (или создаем) пул клиентов Telethon"""
+    global client_pool
+    if client_pool is None:
+        client_pool = ClientPool(TELETHON_SESSIONS)
+    return client_pool
+
+def get_client():
+    """Клиент основного аккаунта"""
+    return get_client_pool().primary.client
+
+# Исходящие сообщения из задач: Bot API пускает около 30 сообщений в секунду
+# на бота и около одного в секунду в чат, дальше отвечает 429 (RetryAfter)
+BOT_GLOBAL_RATE = float(os.getenv('BOT_GLOBAL_RATE', '25'))
+BOT_CHAT_RATE = float(os.getenv('BOT_CHAT_RATE', '1'))
+BOT_CHAT_BURST = int(os.getenv('BOT_CHAT_BURST', '3'))
+BOT_SEND_RETRIES = int(os.getenv('BOT_SEND_RETRIES', '5'))
+MEDIA_GROUP_SIZE = 10  # больше документов в sendMediaGroup Telegram не принимает
+MESSAGE_LIMIT = 4096
+
+class OutboundSender:
+    """Отправка в Telegram через общий и початовые token bucket'ы.
+    На RetryAfter чат ставится на паузу, и запрос повторяется"""
+    def __init__(self, global_rate: float, chat_rate: float, chat_burst: int):
+        self.global_bucket = TokenBucket(global_rate, max(1.0, global_rate))
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.chat_buckets = {}
+        self.blocked_until = {}
+
+    async def _call(self, chat_id: int, method: str, request):
+        """request - фабрика корутины, чтобы при повторе заново открыть файлы"""
+        from aiogram.utils.exceptions import RetryAfter
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        for attempt in range(BOT_SEND_RETRIES + 1):
+            blocked = self.blocked_until.get(chat_id, 0.0) - time.monotonic()
+            if blocked > 0:
+                await asyncio.sleep(blocked)
+            await bucket.acquire()
+            await self.global_bucket.acquire()
+            try:
+                return await request()
+            except RetryAfter as e:
+                BOT_RETRY_AFTER.inc(method=method)
+                if attempt == BOT_SEND_RETRIES:
+                    raise
+                logger.warning(f"RetryAfter {e.timeout} с для чата {chat_id} ({method})")
+                self.blocked_until[chat_id] = time.monotonic() + e.timeout
+
+    async def send_message(self, chat_id: int, text: str, **kwargs):
+        if len(text) > MESSAGE_LIMIT:
+            text = text[:MESSAGE_LIMIT - 1] + "…"
+        return await self._call(chat_id, 'sendMessage', lambda: bot.send_message(chat_id, text, **kwargs))
+
+    async def send_documents(self, chat_id: int, documents: list, on_sent=None):
+        """Отправляем [(путь, подпись, file_id)] группами до MEDIA_GROUP_SIZE, одиночный файл - sendDocument.
+        Документ с file_id уходит без загрузки. on_sent(документы, file_id) вызывается
+        после каждой успешно отправленной группы"""
+        for start in range(0, len(documents), MEDIA_GROUP_SIZE):
+            chunk = documents[start:start + MEDIA_GROUP_SIZE]
+
+            async def request(chunk=chunk):
+                with contextlib.ExitStack() as stack, UPLOAD_SECONDS.time():
+                    files = [file_id or types.InputFile(stack.enter_context(open(path, 'rb')))
+                             for path, _, file_id in chunk]
+                    if len(chunk) == 1:
+                        return [await bot.send_document(chat_id, files[0], caption=chunk[0][1])]
+                    media = types.MediaGroup()
+                    for f, (_, caption, _) in zip(files, chunk):
+                        media.attach_document(f, caption=caption)
+                    return await bot.send_media_group(chat_id, media)
+
+            sent = await self._call(chat_id, 'sendDocument' if len(chunk) == 1 else 'sendMediaGroup', request)
+            if on_sent:
+                on_sent(chunk, [message.document.file_id for message in sent])
+
+outbound = OutboundSender(BOT_GLOBAL_RATE, BOT_CHAT_RATE, BOT_CHAT_BURST)
 
 # Структура для хранения данных
 class UserData:
@@ -219,25 +1131,92 @@ class BotStates(StatesGroup):
     waiting_for_schedule_folder = State()
     waiting_for_schedule_time = State()
 
-def save_report(user_id: int, folder: str, content: str):
+def save_report(user_id: int, folder: str, content: str, cutoff: datetime = None) -> int:
     """Сохраняем отчет в БД"""
     conn = sqlite3.connect('bot.db')
     c = conn.cursor()
-    c.execute('INSERT INTO reports (user_id, folder, content) VALUES (?, ?, ?)',
-              (user_id, folder, content))
+    c.execute('INSERT INTO reports (user_id, folder, content, cutoff) VALUES (?, ?, ?, ?)',
+              (user_id, folder, content, cutoff.isoformat() if cutoff else None))
+    report_id = c.lastrowid
     conn.commit()
     conn.close()
+    return report_id
+
+def get_last_report(user_id: int, folder: str):
+    """Последний отчет по папке: (content, cutoff) или None"""
+    conn = sqlite3.connect('bot.db')
+    c = conn.cursor()
+    c.execute('SELECT content, cutoff FROM reports WHERE user_id = ? AND folder = ? ORDER BY id DESC LIMIT 1',
+              (user_id, folder))
+    row = c.fetchone()
+    conn.close()
+    if not row:
+        return None
+    return row[0], datetime.fromisoformat(row[1]) if row[1] else None
 
 def get_user_reports(user_id: int, limit: int = 10) -> list:
-    """Получаем последние отчеты пользователя"""
+    """Получаем последние отчеты пользователя: [(id, folder, content, created_at)]"""
     conn = sqlite3.connect('bot.db')
     c = conn.cursor()
-    c.execute('SELECT folder, content, created_at FROM reports WHERE user_id = ? ORDER BY created_at DESC LIMIT ?',
-              (user_id, limit))
+    c.execute('SELECT id, folder, content, created_at FROM reports WHERE user_id = ? '
+              'ORDER BY created_at DESC, id DESC LIMIT ?', (user_id, limit))
     reports = c.fetchall()
     conn.close()
     return reports
 
+def iter_user_reports(user_id: int, since: str = None, until: str = None, folder: str = None,
+                      batch_size: int = 500):
+    """Отчеты пользователя курсором, пачками по batch_size, от старых к новым:
+    (id, folder, created_at, cutoff, content). В памяти держится только одна пачка"""
+    query = 'SELECT id, folder, created_at, cutoff, content FROM reports WHERE user_id = ?'
+    params = [user_id]
+    if since:
+        query += ' AND created_at >= ?'
+        params.append(since)
+    if until:
+        query += ' AND created_at < ?'
+        params.append(until)
+    if folder:
+        query += ' AND folder = ?'
+        params.append(folder)
+    conn = sqlite3.connect('bot.db')
+    try:
+        c = conn.cursor()
+        c.execute(query + ' ORDER BY created_at, id', params)
+        while True:
+            rows = c.fetchmany(batch_size)
+            if not rows:
+                break
+            yield from rows
+    finally:
+        conn.close()
+
+def get_report(user_id: int, report_id: int):
+    """Отчет пользователя по id: (folder, content, created_at) или None"""
+    conn = sqlite3.connect('bot.db')
+    c = conn.cursor()
+    c.execute('SELECT folder, content, created_at FROM reports WHERE id = ? AND user_id = ?', (report_id, user_id))
+    row = c.fetchone()
+    conn.close()
+    return row
+
+def save_report_file(report_id: int, format_type: str, file_id: str):
+    conn = sqlite3.connect('bot.db')
+    c = conn.cursor()
+    c.execute('INSERT OR REPLACE INTO report_files (report_id, format, file_id) VALUES (?, ?, ?)',
+              (report_id, format_type, file_id))
+    conn.commit()
+    conn.close()
+
+def load_report_file(report_id: int, format_type: str):
+    """file_id уже отправленного файла отчета или None"""
+    conn = sqlite3.connect('bot.db')
+    c = conn.cursor()
+    c.execute('SELECT file_id FROM report_files WHERE report_id = ? AND format = ?', (report_id, format_type))
+    row = c.fetchone()
+    conn.close()
+    return row[0] if row else None
+
 def save_schedule(user_id: int, folder: str, time: str):
     """Сохраняем расписание в БД"""
     conn = sqlite3.connect('bot.db')
@@ -256,9 +1235,296 @@ def get_active_schedules() -> list:
     conn.close()
     return schedules
 
+def enqueue_job(kind: str, user_id: int, chat_id: int, payload: dict) -> int:
+    """Ставим задачу анализа в очередь"""
+    conn = sqlite3.connect('bot.db')
+    c = conn.cursor()
+    c.execute('INSERT INTO jobs (kind, user_id, chat_id, payload) VALUES (?, ?, ?, ?)',
+              (kind, user_id, chat_id, json.dumps(payload, ensure_ascii=False)))
+    job_id = c.lastrowid
+    conn.commit()
+    conn.close()
+    return job_id
+
+def claim_job(worker_id: str):
+    """Атомарно забираем самую старую задачу из очереди"""
+    conn = sqlite3.connect('bot.db', timeout=30, isolation_level=None)
+    c = conn.cursor()
+    try:
+        c.execute('BEGIN IMMEDIATE')
+        c.execute("SELECT id, kind, user_id, chat_id, payload, attempts, deadline FROM jobs "
+                  "WHERE status = 'queued' ORDER BY id LIMIT 1")
+        row = c.fetchone()
+        if row:
+            # Бюджет времени отсчитывается с первого запуска, а не с постановки в очередь
+            deadline = row[6]
+            budget = json.loads(row[4]).get('budget')
+            if deadline is None and budget:
+                deadline = time.time() + budget
+            c.execute("UPDATE jobs SET status = 'running', worker = ?, attempts = attempts + 1, deadline = ?, "
+                      "started_at = CURRENT_TIMESTAMP, heartbeat_at = CURRENT_TIMESTAMP WHERE id = ?",
+                      (worker_id, deadline, row[0]))
+        c.execute('COMMIT')
+    except Exception:
+        c.execute('ROLLBACK')
+        raise
+    finally:
+        conn.close()
+    if not row:
+        return None
+    return {'id': row[0], 'kind': row[1], 'user_id': row[2], 'chat_id': row[3],
+            'payload': json.loads(row[4]), 'attempts': row[5] + 1, 'deadline': deadline}
+
+def heartbeat_job(job_id: int):
+    """Отмечаем, что воркер еще работает над задачей"""
+    conn = sqlite3.connect('bot.db')
+    c = conn.cursor()
+    c.execute('UPDATE jobs SET heartbeat_at = CURRENT_TIMESTAMP WHERE id = ?', (job_id,))
+    conn.commit()
+    conn.close()
+
+def finish_job(job_id: int, status: str, error: str = None):
+    """Закрываем задачу со статусом done или failed (или возвращаем в очередь)"""
+    conn = sqlite3.connect('bot.db')
+    c = conn.cursor()
+    c.execute('UPDATE jobs SET status = ?, error = ?, finished_at = CURRENT_TIMESTAMP WHERE id = ?',
+              (status, error, job_id))
+    if status in ('done', 'failed'):
+        c.execute('DELETE FROM job_checkpoints WHERE job_id = ?', (job_id,))
+    conn.commit()
+    conn.close()
+
+def release_running_jobs(c, condition: str, params: tuple, max_attempts: int) -> int:
+    """Возвращаем в очередь зависшие задачи. Задачи, исчерпавшие попытки, закрываем как failed:
+    иначе задача, которая роняет воркер, перезапускала бы его бесконечно"""
+    c.execute(f"SELECT id FROM jobs WHERE status = 'running' AND attempts >= ? AND {condition}",
+              (max_attempts,) + params)
+    failed = [row[0] for row in c.fetchall()]
+    for job_id in failed:
+        logger.error(f"Задача {job_id} исчерпала попытки (воркер упал или завис), помечаю как failed")
+        c.execute("UPDATE jobs SET status = 'failed', worker = NULL, error = ?, finished_at = CURRENT_TIMESTAMP "
+                  "WHERE id = ?", ("Воркер упал или завис во время выполнения", job_id))
+        c.execute('DELETE FROM job_checkpoints WHERE job_id = ?', (job_id,))
+    c.execute(f"UPDATE jobs SET status = 'queued', worker = NULL WHERE status = 'running' AND {condition}",
+              params)
+    return c.rowcount
+
+def requeue_worker_jobs(worker_id: str, max_attempts: int) -> int:
+    """После рестарта воркера сразу возвращаем в очередь его незавершенные задачи"""
+    conn = sqlite3.connect('bot.db', timeout=30)
+    c = conn.cursor()
+    count = release_running_jobs(c, 'worker = ?', (worker_id,), max_attempts)
+    conn.commit()
+    conn.close()
+    return count
+
+class Checkpoints:
+    """Чекпоинты одной задачи: {(stage, key): data}, хранятся в job_checkpoints"""
+    def __init__(self, job_id: int):
+        self.job_id = job_id
+        conn = sqlite3.connect('bot.db')
+        c = conn.cursor()
+        c.execute('SELECT stage, key, data FROM job_checkpoints WHERE job_id = ?', (job_id,))
+        self.data = {(stage, key): json.loads(data) for stage, key, data in c.fetchall()}
+        conn.close()
+
+    def get(self, stage: str, key: str):
+        return self.data.get((stage, key))
+
+    def set(self, stage: str, key: str, value):
+        self.data[(stage, key)] = value
+        conn = sqlite3.connect('bot.db')
+        c = conn.cursor()
+        c.execute('INSERT OR REPLACE INTO job_checkpoints (job_id, stage, key, data) VALUES (?, ?, ?, ?)',
+                  (self.job_id, stage, key, json.dumps(value, ensure_ascii=False)))
+        conn.commit()
+        conn.close()
+
+def requeue_stale_jobs(stale_seconds: int, max_attempts: int) -> int:
+    """Возвращаем в очередь задачи воркеров, которые перестали слать heartbeat"""
+    conn = sqlite3.connect('bot.db', timeout=30)
+    c = conn.cursor()
+    count = release_running_jobs(c, "heartbeat_at < datetime('now', ?)", (f'-{stale_seconds} seconds',),
+                                 max_attempts)
+    conn.commit()
+    conn.close()
+    return count
+
+def count_queued_jobs() -> int:
+    """Сколько задач ждет в очереди"""
+    conn = sqlite3.connect('bot.db')
+    c = conn.cursor()
+    c.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'")
+    count = c.fetchone()[0]
+    conn.close()
+    return count
+
+def get_job_status(job_id: int):
+    """Статус задачи (или None, если такой нет)"""
+    conn = sqlite3.connect('bot.db')
+    c = conn.cursor()
+    c.execute('SELECT status FROM jobs WHERE id = ?', (job_id,))
+    row = c.fetchone()
+    conn.close()
+    return row[0] if row else None
+
+def load_channel_digest(channel: str, window_hours: int):
+    """Выжимка канала за окно: (last_post_id, digest, возраст в секундах) или None"""
+    conn = sqlite3.connect('bot.db')
+    c = conn.cursor()
+    c.execute("SELECT last_post_id, digest, strftime('%s', 'now') - strftime('%s', created_at) "
+              "FROM channel_digests WHERE channel = ? AND window_hours = ?", (channel, window_hours))
+    row = c.fetchone()
+    conn.close()
+    return row
+
+def save_channel_digest(channel: str, window_hours: int, last_post_id: int, post_count: int, digest: str):
+    """Сохраняем (заменяем) выжимку канала"""
+    conn = sqlite3.connect('bot.db')
+    c = conn.cursor()
+    c.execute('INSERT OR REPLACE INTO channel_digests (channel, window_hours, last_post_id, post_count, digest) '
+              'VALUES (?, ?, ?, ?, ?)', (channel, window_hours, last_post_id, post_count, digest))
+    conn.commit()
+    conn.close()
+
+def load_backfill_partition(channel: str, part_start: str, part_end: str):
+    """Прогресс диапазона: (oldest_id, done) или None"""
+    conn = sqlite3.connect('bot.db')
+    c = conn.cursor()
+    c.execute('SELECT oldest_id, done FROM backfill_partitions WHERE channel = ? AND part_start = ? AND part_end = ?',
+              (channel, part_start, part_end))
+    row = c.fetchone()
+    conn.close()
+    return row
+
+def save_backfill_batch(channel: str, part_start: str, part_end: str, messages: list, oldest_id: int, done: bool):
+    """Одной транзакцией сохраняем пачку постов и прогресс диапазона"""
+    conn = sqlite3.connect('bot.db', timeout=30)
+    c = conn.cursor()
+    # Upsert, а не INSERT OR REPLACE: замена не вызывает триггер удаления и оставила бы мусор в FTS
+    c.executemany('INSERT INTO channel_posts (channel, id, date, text) VALUES (?, ?, ?, ?) '
+                  'ON CONFLICT (channel, id) DO UPDATE SET date = excluded.date, text = excluded.text',
+                  [(channel, m[0], m[1].astimezone(timezone.utc).isoformat(), m[2]) for m in messages])
+    c.execute('INSERT OR REPLACE INTO backfill_partitions (channel, part_start, part_end, oldest_id, done) '
+              'VALUES (?, ?, ?, ?, ?)', (channel, part_start, part_end, oldest_id, int(done)))
+    conn.commit()
+    conn.close()
+
+def load_channel_posts(channel: str, since: datetime) -> list:
+    """Сохраненные посты канала не старше since: [(id, date, text)], от новых к старым"""
+    conn = sqlite3.connect('bot.db')
+    c = conn.cursor()
+    c.execute('SELECT id, date, text FROM channel_posts WHERE channel = ? AND date >= ? ORDER BY id DESC',
+              (channel, since.astimezone(timezone.utc).isoformat()))
+    rows = [(row[0], datetime.fromisoformat(row[1]), row[2]) for row in c.fetchall()]
+    conn.close()
+    return rows
+
+def save_ingested_posts(channel: str, messages: list, covered_since, synced_at):
+    """Одной транзакцией сохраняем посты из буфера и его состояние для других процессов"""
+    conn = sqlite3.connect('bot.db', timeout=30)
+    c = conn.cursor()
+    c.executemany('INSERT INTO channel_posts (channel, id, date, text) VALUES (?, ?, ?, ?) '
+                  'ON CONFLICT (channel, id) DO UPDATE SET date = excluded.date, text = excluded.text',
+                  [(channel, m[0], m[1].astimezone(timezone.utc).isoformat(), m[2]) for m in messages])
+    c.execute('INSERT OR REPLACE INTO ingest_channels (channel, covered_since, synced_at) VALUES (?, ?, ?)',
+              (channel, covered_since.astimezone(timezone.utc).isoformat() if covered_since else None, synced_at))
+    conn.commit()
+    conn.close()
+
+def load_ingest_state(channel: str):
+    """Состояние общего буфера канала: (covered_since, synced_at) или None"""
+    conn = sqlite3.connect('bot.db')
+    c = conn.cursor()
+    c.execute('SELECT covered_since, synced_at FROM ingest_channels WHERE channel = ?', (channel,))
+    row = c.fetchone()
+    conn.close()
+    if not row or not row[0]:
+        return None
+    return datetime.fromisoformat(row[0]), row[1] or 0
+
+def clear_ingest_state(channel: str = None):
+    """Забываем состояние общего буфера канала (или всех каналов)"""
+    conn = sqlite3.connect('bot.db', timeout=30)
+    c = conn.cursor()
+    if channel is None:
+        c.execute('DELETE FROM ingest_channels')
+    else:
+        c.execute('DELETE FROM ingest_channels WHERE channel = ?', (channel,))
+    conn.commit()
+    conn.close()
+
+SEARCH_PAGE_SIZE = 5
+SNIPPET_TOKENS = 16
+
+def prune_channel_posts(older_than: datetime) -> int:
+    """Удаляем сохраненные посты и прогресс выгрузки старше older_than"""
+    cutoff = older_than.astimezone(timezone.utc).isoformat()
+    conn = sqlite3.connect('bot.db', timeout=30)
+    c = conn.cursor()
+    c.execute('DELETE FROM channel_posts WHERE date < ?', (cutoff,))
+    count = c.rowcount
+    c.execute('DELETE FROM backfill_partitions WHERE part_end < ?', (cutoff,))
+    conn.commit()
+    conn.close()
+    return count
+
+def fts_query(text: str) -> str:
+    """Запрос пользователя -> выражение FTS5: все слова обязательны, каждое ищется
+    как префикс, чтобы находились другие падежи и формы"""
+    words = re.findall(r'\w+', text)
+    return ' '.join('"' + word + '"*' for word in words)
+
+def search_reports(user_id: int, query: str, limit: int, offset: int = 0) -> list:
+    """Отчеты пользователя по релевантности (bm25): [(id, folder, created_at, snippet)]"""
+    conn = sqlite3.connect('bot.db')
+    c = conn.cursor()
+    c.execute(f"""SELECT r.id, r.folder, r.created_at,
+                         snippet(reports_fts, 1, '\x02', '\x03', '…', {SNIPPET_TOKENS})
+                  FROM reports_fts JOIN reports r ON r.id = reports_fts.rowid
+                  WHERE reports_fts MATCH ? AND r.user_id = ?
+                  ORDER BY bm25(reports_fts, 2.0, 1.0) LIMIT ? OFFSET ?""",
+              (fts_query(query), user_id, limit, offset))
+    rows = c.fetchall()
+    conn.close()
+    return rows
+
+def search_posts(channels: list, query: str, limit: int, offset: int = 0) -> list:
+    """Сохраненные посты каналов по релевантности: [(channel, id, date, snippet)]"""
+    if not channels:
+        return []
+    conn = sqlite3.connect('bot.db')
+    c = conn.cursor()
+    placeholders = ', '.join('?' * len(channels))
+    c.execute(f"""SELECT p.channel, p.id, p.date,
+                         snippet(channel_posts_fts, 0, '\x02', '\x03', '…', {SNIPPET_TOKENS})
+                  FROM channel_posts_fts JOIN channel_posts p ON p.rowid = channel_posts_fts.rowid
+                  WHERE channel_posts_fts MATCH ? AND p.channel IN ({placeholders})
+                  ORDER BY bm25(channel_posts_fts) LIMIT ? OFFSET ?""",
+              [fts_query(query)] + [channel.lower() for channel in channels] + [limit, offset])
+    rows = c.fetchall()
+    conn.close()
+    return rows
+
+def report_file_path(folder: str, extension: str) -> str:
+    """Уникальный путь для файла отчета: у каждого файла своя временная папка, поэтому
+    параллельные задачи с одинаковой папкой не перетирают файлы друг друга, а имя файла,
+    которое видит пользователь, остается прежним"""
+    directory = tempfile.mkdtemp(prefix='suckfox_report_')
+    name = re.sub(r'[\\/:*?"<>|]+', '_', folder)
+    return os.path.join(directory, f"analysis_{name}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{extension}")
+
+def remove_report_file(filename: str):
+    """Удаляем файл отчета вместе с его временной папкой"""
+    os.remove(filename)
+    try:
+        os.rmdir(os.path.dirname(filename))
+    except OSError:
+        pass
+
 def generate_txt_report(content: str, folder: str) -> str:
     """Генерирует отчет в формате TXT"""
-    filename = f"analysis_{folder}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt"
+    filename = report_file_path(folder, 'txt')
     with open(filename, 'w', encoding='utf-8') as f:
         f.write(content)
     return filename
@@ -303,17 +1569,29 @@ def get_font_path():
         logger.error(f"Не удалось скачать шрифт: {str(e)}")
         raise Exception("Не удалось найти или скачать шрифт DejaVuSans.ttf")
 
+_pdf_font_registered = False
+
+def register_pdf_font():
+    """Регистрируем шрифт DejaVu (поддерживает русский) один раз за процесс"""
+    global _pdf_font_registered
+    if not _pdf_font_registered:
+        from reportlab.pdfbase import pdfmetrics
+        from reportlab.pdfbase.ttfonts import TTFont
+        pdfmetrics.registerFont(TTFont('DejaVu', get_font_path()))
+        _pdf_font_registered = True
+
 def generate_pdf_report(content: str, folder: str) -> str:
     """Генерирует отчет в формате PDF"""
-    filename = f"analysis_{folder}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.pdf"
+    from reportlab.pdfgen import canvas
+    from reportlab.lib.pagesizes import A4
+    
+    filename = report_file_path(folder, 'pdf')
     
     # Создаем PDF с поддержкой русского
     c = canvas.Canvas(filename, pagesize=A4)
     width, height = A4
     
-    # Регистрируем шрифт DejaVu (поддерживает русский)
-    font_path = get_font_path()
-    pdfmetrics.registerFont(TTFont('DejaVu', font_path))
+    register_pdf_font()
     
     # Пишем заголовок
     c.setFont('DejaVu', 16)  # Увеличенный размер для основного заголовка
@@ -388,6 +1666,26 @@ def generate_pdf_report(content: str, folder: str) -> str:
     c.save()
     return filename
 
+REPORT_RENDERERS = {'txt': generate_txt_report, 'pdf': generate_pdf_report}
+
+async def send_report_file(chat_id: int, report_id: int, folder: str, content: str, format_type: str):
+    """Файл отчета: по сохраненному file_id, а если его нет - генерируем, загружаем и запоминаем"""
+    caption = f"📄 Отчет по папке {folder} ({format_type.upper()})"
+    file_id = load_report_file(report_id, format_type)
+    if file_id:
+        CACHE_HITS.inc(cache='report_file')
+        await outbound.send_documents(chat_id, [(None, caption, file_id)])
+        return
+    CACHE_MISSES.inc(cache='report_file')
+    with RENDER_SECONDS.time(format=format_type):
+        filename = REPORT_RENDERERS[format_type](content, folder)
+    try:
+        await outbound.send_documents(chat_id, [(filename, caption, None)],
+                                      on_sent=lambda sent, file_ids: save_report_file(report_id, format_type,
+                                                                                      file_ids[0]))
+    finally:
+        remove_report_file(filename)
+
 @dp.message_handler(commands=['start'])
 async def cmd_start(message: types.Message):
     me = await bot.get_me()
@@ -606,49 +1904,90 @@ async def process_new_prompt(message: types.Message, state: FSMContext):
         reply_markup=keyboard
     )
 
+def selected_model_choice(user_id: int) -> int:
+    """Индекс выбранной пары (провайдер, модель) в MODEL_CATALOG['choices'] или -1"""
+    user_settings = user_data.get_user_data(user_id)['ai_settings']
+    return MODEL_CATALOG['choice_index'].get((user_settings['provider_index'], user_settings['model']), -1)
+
 @dp.message_handler(lambda message: message.text == "⚙️ Настройка ИИ")
 async def ai_settings(message: types.Message):
     # Получаем текущие настройки пользователя
     user_settings = user_data.get_user_data(message.from_user.id)['ai_settings']
-    current_provider = PROVIDER_HIERARCHY[user_settings['provider_index']]['provider'].__name__
+    current_provider = PROVIDER_HIERARCHY[user_settings['provider_index']]['provider']
     current_model = user_settings['model']
     
-    # Создаем клавиатуру для выбора модели
-    keyboard = types.InlineKeyboardMarkup(row_width=1)
-    for provider_info in PROVIDER_HIERARCHY:
-        for model in provider_info['models']:
-            keyboard.add(
-                types.InlineKeyboardButton(
-                    f"{'✅ ' if model == current_model else ''}{model} ({provider_info['provider'].__name__})",
-                    callback_data=f"select_model_{provider_info['provider'].__name__}_{model}"
-                )
-            )
+    # Открываем страницу с текущей моделью
+    selected = selected_model_choice(message.from_user.id)
+    page = max(selected, 0) // MODELS_PAGE_SIZE
     
     await message.answer(
         f"📊 Текущие настройки ИИ:\n\n"
         f"🔹 Провайдер: {current_provider}\n"
         f"🔹 Модель: {current_model}\n\n"
         f"ℹ️ Выберите предпочитаемую модель из списка:",
-        reply_markup=keyboard
+        reply_markup=build_models_keyboard(page, selected)
+    )
+
+@dp.callback_query_handler(lambda c: c.data == 'noop')
+async def process_noop(callback_query: types.CallbackQuery):
+    await callback_query.answer()
+
+@dp.callback_query_handler(lambda c: c.data.startswith('mp:'))
+async def process_models_page(callback_query: types.CallbackQuery):
+    page = int(callback_query.data[3:])
+    await callback_query.message.edit_reply_markup(
+        reply_markup=build_models_keyboard(page, selected_model_choice(callback_query.from_user.id))
     )
+    await callback_query.answer()
 
-@dp.callback_query_handler(lambda c: c.data.startswith('select_model_'))
+@dp.callback_query_handler(lambda c: c.data.startswith('m:'))
 async def process_model_selection(callback_query: types.CallbackQuery):
-    _, provider_name, model = callback_query.data.split('_', 2)
+    choice = int(callback_query.data[2:])
+    if not 0 <= choice < len(MODEL_CATALOG['choices']):
+        await callback_query.answer("Модель не найдена")
+        return
+    provider_index, model = MODEL_CATALOG['choices'][choice]
+    provider_name = PROVIDER_HIERARCHY[provider_index]['provider']
     
     # Обновляем настройки пользователя
-    for index, provider_info in enumerate(PROVIDER_HIERARCHY):
-        if provider_info['provider'].__name__ == provider_name:
-            user_data.get_user_data(callback_query.from_user.id)['ai_settings']['provider_index'] = index
-            break
-    user_data.get_user_data(callback_query.from_user.id)['ai_settings']['model'] = model
+    user_settings = user_data.get_user_data(callback_query.from_user.id)['ai_settings']
+    user_settings['provider_index'] = provider_index
+    user_settings['model'] = model
     user_data.save()
     
     await callback_query.message.edit_text(
         f"✅ Модель {model} от провайдера {provider_name} успешно выбрана!"
     )
 
-async def try_gpt_request(prompt: str, posts_text: str, user_id: int):
+# Таймаут запроса к провайдеру: перцентиль его недавних успешных ответов с запасом,
+# но не больше, чем осталось до дедлайна задачи
+LLM_TIMEOUT_DEFAULT = float(os.getenv('LLM_TIMEOUT_DEFAULT', '30'))
+LLM_TIMEOUT_MIN = float(os.getenv('LLM_TIMEOUT_MIN', '10'))
+LLM_TIMEOUT_MAX = float(os.getenv('LLM_TIMEOUT_MAX', '120'))
+LLM_TIMEOUT_PERCENTILE = float(os.getenv('LLM_TIMEOUT_PERCENTILE', '95'))
+LLM_TIMEOUT_FACTOR = float(os.getenv('LLM_TIMEOUT_FACTOR', '1.5'))
+LLM_LATENCY_SAMPLES = 100
+provider_latencies = {}  # {провайдер: последние длительности успешных ответов}
+
+def record_provider_latency(provider: str, seconds: float):
+    samples = provider_latencies.setdefault(provider, [])
+    samples.append(seconds)
+    if len(samples) > LLM_LATENCY_SAMPLES:
+        del samples[0]
+
+def provider_timeout(provider: str) -> float:
+    """Таймаут по наблюдаемой задержке провайдера и оставшемуся бюджету"""
+    samples = sorted(provider_latencies.get(provider, []))
+    if len(samples) >= 5:
+        observed = samples[min(len(samples) - 1, int(len(samples) * LLM_TIMEOUT_PERCENTILE / 100))]
+        timeout = min(LLM_TIMEOUT_MAX, max(LLM_TIMEOUT_MIN, observed * LLM_TIMEOUT_FACTOR))
+    else:
+        timeout = LLM_TIMEOUT_DEFAULT
+    left = time_left()
+    return timeout if left is None else min(timeout, left)
+
+async def try_gpt_request(prompt: str, posts_text: str, user_id: int, model: str = None,
+                          provider_index: int = None):
     """Пытаемся получить ответ от GPT, перебирая провайдеров"""
     last_error = None
     rate_limited_providers = set()
@@ -675,31 +2014,32 @@ async def try_gpt_request(prompt: str, posts_text: str, user_id: int):
     except Exception as e:
         logger.warning(f"Ошибка при очистке кэша: {str(e)}")
     
-    # Всегда начинаем с DDG
-    providers_to_try = [PROVIDER_HIERARCHY[0]]  # DDG первый
-    other_providers = PROVIDER_HIERARCHY[1:]  # Остальные в случайном порядке
-    random.shuffle(other_providers)
-    providers_to_try.extend(other_providers)
+    # Порядок провайдеров строится по каталогу моделей: сначала те, кто умеет
+    # выбранную модель, и только потом замены
+    if model is None:
+        user_settings = user_data.get_user_data(user_id)['ai_settings']
+        model = user_settings['model']
+        provider_index = user_settings['provider_index']
+    providers_to_try = provider_fallback_chain(model, provider_index)
     
     # Генерируем случайный ID сессии
     session_id = ''.join(random.choices('abcdefghijklmnopqrstuvwxyz0123456789', k=32))
     
-    for provider_info in providers_to_try:
+    for index, model_to_use in providers_to_try:
+        provider_info = PROVIDER_HIERARCHY[index]
         if provider_info['provider'] in rate_limited_providers:
             continue
             
+        check_deadline('запрос к ИИ', reserve=1)
+        request_started = None
         try:
-            logger.info(f"Пробую провайдера {provider_info['provider'].__name__}")
+            logger.info(f"Пробую провайдера {provider_info['provider']}")
             
-            # Проверяем поддержку модели
-            current_model = user_data.get_user_data(user_id)['ai_settings']['model']
-            if current_model not in provider_info['models']:
-                model_to_use = provider_info['models'][0]
-                logger.info(f"Модель {current_model} не поддерживается, использую {model_to_use}")
-            else:
-                model_to_use = current_model
+            if model_to_use != model:
+                logger.info(f"Модель {model} у провайдера недоступна, использую {model_to_use}")
             
             # Добавляем случайные заголовки и параметры
+            g4f = get_g4f()
             g4f.debug.logging = False
             g4f.check_version = False
             
@@ -716,19 +2056,29 @@ async def try_gpt_request(prompt: str, posts_text: str, user_id: int):
                 'X-Request-ID': f'{random.randint(1000, 9999)}-{random.randint(1000, 9999)}'
             }
             
-            # Добавляем случайную задержку
-            await asyncio.sleep(random.uniform(1.0, 3.0))
+            # Добавляем случайную задержку (при почти исчерпанном бюджете - короче)
+            left = time_left()
+            await asyncio.sleep(random.uniform(1.0, 3.0) if left is None else min(random.uniform(1.0, 3.0), left / 20))
             
-            response = await g4f.ChatCompletion.create_async(
-                model=model_to_use,
-                messages=[{"role": "user", "content": f"{prompt}\n\nДанные для анализа:\n{posts_text}"}],
-                provider=provider_info['provider'],
-                headers=headers,
-                proxy=None,
-                timeout=30
-            )
+            timeout = provider_timeout(provider_info['provider'])
+            request_started = time.perf_counter()
+            try:
+                response = await asyncio.wait_for(g4f.ChatCompletion.create_async(
+                    model=model_to_use,
+                    messages=[{"role": "user", "content": f"{prompt}\n\nДанные для анализа:\n{posts_text}"}],
+                    provider=get_provider(provider_info['provider']),
+                    headers=headers,
+                    proxy=None,
+                    connector=get_http_connector(),
+                    timeout=timeout
+                ), timeout)
+            except asyncio.TimeoutError:
+                raise Exception(f"Timeout: нет ответа за {timeout:.0f} с")
             
             if response and len(response.strip()) > 0:
+                elapsed = time.perf_counter() - request_started
+                LLM_REQUEST_SECONDS.observe(elapsed, provider=provider_info['provider'], status='ok')
+                record_provider_latency(provider_info['provider'], elapsed)
                 return response
             else:
                 raise Exception("Пустой ответ от провайдера")
@@ -736,31 +2086,242 @@ async def try_gpt_request(prompt: str, posts_text: str, user_id: int):
         except Exception as e:
             error_str = str(e)
             last_error = error_str
-            logger.error(f"Ошибка с провайдером {provider_info['provider'].__name__}: {error_str}")
+            logger.error(f"Ошибка с провайдером {provider_info['provider']}: {error_str}")
+            if request_started is not None:
+                LLM_REQUEST_SECONDS.observe(time.perf_counter() - request_started,
+                                            provider=provider_info['provider'], status='error')
+            LLM_FAILURES.inc(provider=provider_info['provider'], cause=classify_llm_error(error_str))
             
             if "429" in error_str or "ERR_INPUT_LIMIT" in error_str:
                 rate_limited_providers.add(provider_info['provider'])
-                logger.warning(f"Провайдер {provider_info['provider'].__name__} временно заблокирован")
+                logger.warning(f"Провайдер {provider_info['provider']} временно заблокирован")
                 await asyncio.sleep(5.0)
             else:
                 await asyncio.sleep(1.0)
                 
             continue
     
+    check_deadline('запрос к ИИ', reserve=1)
     if len(rate_limited_providers) > 0:
         raise Exception(f"Все доступные провайдеры временно заблокированы. Попробуйте позже. Последняя ошибка: {last_error}")
     else:
         raise Exception(f"Все провайдеры перепробованы. Последняя ошибка: {last_error}")
 
+# Фоновое получение постов через события NewMessage (PUSH_INGESTION=1):
+# посты каналов из всех папок копятся в памяти, и анализ стартует сразу,
+# догружая из Telegram только то, что появилось после последнего поста буфера
+PUSH_INGESTION = os.getenv('PUSH_INGESTION', '0') == '1'
+INGEST_WINDOW_HOURS = int(os.getenv('INGEST_WINDOW_HOURS', '24'))
+INGEST_MAX_POSTS = int(os.getenv('INGEST_MAX_POSTS', '1000'))
+INGEST_REFRESH_MINUTES = int(os.getenv('INGEST_REFRESH_MINUTES', '5'))
+# Сколько секунд после последней сверки с Telegram теплый канал отдается прямо из буфера,
+# полагаясь на события; позже перед анализом догружаются посты после последнего в буфере
+INGEST_CATCHUP_SECONDS = int(os.getenv('INGEST_CATCHUP_SECONDS', '300'))
+HISTORY_LIMIT = int(os.getenv('HISTORY_LIMIT', '100'))
+
+# Длинные окна (7 и 30 дней) выгружаются в bot.db по суточным диапазонам
+# параллельно; готовые диапазоны в прошлом больше не перекачиваются
+BACKFILL_PARTITION_HOURS = int(os.getenv('BACKFILL_PARTITION_HOURS', '24'))
+BACKFILL_PARALLEL = int(os.getenv('BACKFILL_PARALLEL', '4'))
+BACKFILL_BATCH = int(os.getenv('BACKFILL_BATCH', '500'))
+HISTORY_PAGE_SIZE = 100  # столько сообщений Telethon получает одним запросом GetHistory
+# Сохраненные посты старше самого длинного окна анализа (плюс один диапазон) удаляются;
+# 0 - считать по ANALYSIS_WINDOWS
+POSTS_RETENTION_HOURS = int(os.getenv('POSTS_RETENTION_HOURS', '0'))
+
+class PostBuffer:
+    """Скользящее окно последних постов по каналам: {канал: {id: (id, date, text)}}"""
+    def __init__(self, window_hours: int, max_posts: int):
+        self.window = timedelta(hours=window_hours)
+        self.max_posts = max_posts
+        self.posts = {}
+        self.covered_since = {}  # канал -> с какого момента в буфере есть все посты
+        self.last_id = {}
+        self.synced_at = {}  # канал -> time.time() последней сверки с историей канала
+        self.channel_ids = {}  # peer id -> канал
+
+    @staticmethod
+    def key(channel_link: str) -> str:
+        return channel_link.lower()
+
+    def track(self, channel_link: str, peer_id: int):
+        self.channel_ids[peer_id] = self.key(channel_link)
+
+    def add(self, channel_link: str, messages: list):
+        key = self.key(channel_link)
+        posts = self.posts.setdefault(key, {})
+        for message in messages:
+            posts[message[0]] = message
+            if message[0] > self.last_id.get(key, 0):
+                self.last_id[key] = message[0]
+        self._prune(key)
+
+    def seed(self, channel_link: str, messages: list, since: datetime):
+        """Кладем результат полной выгрузки истории: с since буфер считается полным"""
+        key = self.key(channel_link)
+        if key not in self.covered_since or since < self.covered_since[key]:
+            self.covered_since[key] = since
+        self.add(channel_link, messages)
+        self.mark_synced(channel_link)
+
+    def mark_synced(self, channel_link: str):
+        self.synced_at[self.key(channel_link)] = time.time()
+
+    def is_fresh(self, channel_link: str) -> bool:
+        synced = self.synced_at.get(self.key(channel_link))
+        return synced is not None and time.time() - synced < INGEST_CATCHUP_SECONDS
+
+    def is_warm(self, channel_link: str, since: datetime) -> bool:
+        covered = self.covered_since.get(self.key(channel_link))
+        return covered is not None and covered <= since
+
+    def get(self, channel_link: str, since: datetime) -> list:
+        """Посты канала не старше since, от новых к старым"""
+        posts = self.posts.get(self.key(channel_link), {})
+        return sorted((m for m in posts.values() if m[1] >= since), key=lambda m: m[0], reverse=True)
+
+    def forget(self, key: str):
+        self.posts.pop(key, None)
+        self.covered_since.pop(key, None)
+        self.last_id.pop(key, None)
+        self.synced_at.pop(key, None)
+        for peer_id in [pid for pid, k in self.channel_ids.items() if k == key]:
+            del self.channel_ids[peer_id]
+
+    def _prune(self, key: str):
+        posts = self.posts[key]
+        threshold = datetime.now(timezone.utc) - self.window
+        for message_id in [mid for mid, m in posts.items() if m[1] < threshold]:
+            del posts[message_id]
+        if len(posts) > self.max_posts:
+            for message_id in sorted(posts)[:len(posts) - self.max_posts]:
+                del posts[message_id]
+            # Самые старые посты выкинуты - буфер полон только с самого старого оставшегося
+            if key in self.covered_since:
+                oldest = min(m[1] for m in posts.values())
+                self.covered_since[key] = max(self.covered_since[key], oldest)
+        if key in self.covered_since:
+            self.covered_since[key] = max(self.covered_since[key], threshold)
+
+post_buffer = PostBuffer(INGEST_WINDOW_HOURS, INGEST_MAX_POSTS)
+# События слушает один процесс: бот без воркеров или воркер INGEST_WORKER_ID.
+# Он делится буфером через bot.db, остальные воркеры читают посты оттуда
+INGEST_WORKER_ID = 'w0'
+ingestion_running = False
+
+def share_buffer(channel_link: str, messages: list):
+    """Пишем изменения буфера в bot.db, если анализ идет в других процессах"""
+    if ANALYSIS_WORKERS:
+        key = post_buffer.key(channel_link)
+        save_ingested_posts(key, messages, post_buffer.covered_since.get(key), post_buffer.synced_at.get(key))
+
+async def get_shared_channel_messages(channel_link: str, hours: int, since: datetime):
+    """Посты из буфера процесса с событиями, сохраненного в bot.db.
+    None - если буфер канала не покрывает окно и историю надо выгружать целиком"""
+    key = post_buffer.key(channel_link)
+    state = load_ingest_state(key)
+    if state is None or state[0] > since:
+        return None
+    CACHE_HITS.inc(cache='post_buffer')
+    messages = load_channel_posts(key, since)
+    if time.time() - state[1] < INGEST_CATCHUP_SECONDS:
+        return messages
+    # Давно не сверялись с историей: догружаем только то, что могло пройти мимо событий
+    missed = await pull_channel_messages(channel_link, hours, min_id=messages[0][0] if messages else 0,
+                                         catch_up=True)
+    if missed is None:
+        logger.warning(f"Не удалось догрузить посты канала {channel_link}, использую буфер")
+        return messages
+    save_ingested_posts(key, missed, state[0], time.time())
+    known = {m[0] for m in messages}
+    return sorted(messages + [m for m in missed if m[0] not in known], key=lambda m: m[0], reverse=True)
+
 async def get_channel_posts(channel_link: str, hours: int = 24) -> list:
     """Получаем посты из канала за последние hours часов"""
+    return [text for _, _, text in await get_channel_messages(channel_link, hours) or []]
+
+async def get_channel_messages(channel_link: str, hours: int = 24) -> list:
+    """Получаем посты канала за последние hours часов как [(id, date, text)], от новых к старым.
+    None - канал прочитать не удалось"""
+    since = datetime.now(timezone.utc) - timedelta(hours=hours)
+    with CHANNEL_FETCH_SECONDS.time():
+        if hours > 24:
+            return await backfill_channel(channel_link, since)
+        
+        if PUSH_INGESTION and not ingestion_running:
+            shared = await get_shared_channel_messages(channel_link, hours, since)
+            if shared is not None:
+                return shared
+        
+        if ingestion_running and post_buffer.is_warm(channel_link, since):
+            CACHE_HITS.inc(cache='post_buffer')
+            if post_buffer.is_fresh(channel_link):
+                return post_buffer.get(channel_link, since)
+            key = post_buffer.key(channel_link)
+            # Догружаем только то, что могло пройти мимо событий
+            missed = await pull_channel_messages(channel_link, hours, min_id=post_buffer.last_id.get(key, 0),
+                                                  catch_up=True)
+            if missed is None:
+                logger.warning(f"Не удалось догрузить посты канала {channel_link}, использую буфер")
+            else:
+                post_buffer.add(channel_link, missed)
+                post_buffer.mark_synced(channel_link)
+                share_buffer(channel_link, missed)
+            return post_buffer.get(channel_link, since)
+        
+        messages = await pull_channel_messages(channel_link, hours)
+        if messages is None:
+            return None
+        if PUSH_INGESTION:
+            CACHE_MISSES.inc(cache='post_buffer')
+        if ingestion_running:
+            # Если упёрлись в лимит истории, полными считаем посты только с самого старого полученного
+            covered = messages[-1][1] if len(messages) >= HISTORY_LIMIT else since
+            post_buffer.seed(channel_link, messages, max(covered, since))
+            share_buffer(channel_link, messages)
+        return messages
+
+async def pull_channel_messages(channel_link: str, hours: int, min_id: int = 0, catch_up: bool = False):
+    """Забираем историю канала через пул аккаунтов. None - если получить не удалось"""
+    from telethon.errors import FloodWaitError
+    
+    pool = get_client_pool()
+    tried = set()
+    while True:
+        account = await pool.acquire(channel_link, exclude=tried)
+        if account is None:
+            logger.error(f"Нет свободных аккаунтов для чтения канала {channel_link}")
+            return None
+        try:
+            return await _fetch_channel_messages(account.client, channel_link, hours, min_id, catch_up)
+        except FloodWaitError as e:
+            FLOOD_WAITS.inc(account=account.name)
+            FLOOD_WAIT_SECONDS.inc(e.seconds, account=account.name)
+            logger.error(f"FloodWait {e.seconds} сек при получении постов из канала {channel_link}")
+            pool.report_flood(account, e.seconds)
+            if account.name in tried:
+                # Повторный FloodWait на том же аккаунте - больше не ждем
+                return None
+            tried.add(account.name)
+
+async def _fetch_channel_messages(client, channel_link: str, hours: int, min_id: int = 0,
+                                  catch_up: bool = False):
+    from telethon.tl.functions.channels import JoinChannelRequest
+    from telethon.errors import ChannelPrivateError, UsernameNotOccupiedError, FloodWaitError
+    
     try:
         logger.info(f"Получаю посты из канала {channel_link}")
         
         if not is_valid_channel(channel_link):
             logger.error(f"Невалидная ссылка на канал: {channel_link}")
-            return []
+            return None
             
+        if catch_up:
+            # Догрузка теплого канала: он уже получен и прочитан этим процессом, поэтому
+            # берем peer из кэша сессии без ResolveUsername и не вступаем в канал повторно
+            return await _read_history(client, await client.get_input_entity(channel_link),
+                                       channel_link, hours, min_id)
+        
         try:
             # Пытаемся присоединиться к каналу
             channel = await client.get_entity(channel_link)
@@ -772,25 +2333,195 @@ async def get_channel_posts(channel_link: str, hours: int = 24) -> list:
                 # Продолжаем работу, возможно мы уже подписаны
         except (ChannelPrivateError, UsernameNotOccupiedError) as e:
             logger.error(f"Не удалось получить доступ к каналу {channel_link}: {str(e)}")
-            return []
+            return None
         
-        # Получаем историю сообщений
-        posts = []
-        time_threshold = datetime.now(channel.date.tzinfo) - timedelta(hours=hours)
-        
-        async for message in client.iter_messages(channel, limit=100):
-            if message.date < time_threshold:
-                break
-                
-            if message.text and len(message.text.strip()) > 0:
-                posts.append(message.text)
+        if ingestion_running:
+            from telethon.utils import get_peer_id
+            post_buffer.track(channel_link, get_peer_id(channel))
         
-        logger.info(f"Получено {len(posts)} постов из канала {channel_link}")
-        return posts
+        return await _read_history(client, channel, channel_link, hours, min_id)
         
+    except FloodWaitError:
+        # Обрабатывается в pull_channel_messages: пробуем другой аккаунт
+        raise
     except Exception as e:
         logger.error(f"Ошибка при получении постов из канала {channel_link}: {str(e)}")
-        return []
+        return None
+
+async def _read_history(client, channel, channel_link: str, hours: int, min_id: int = 0) -> list:
+    """Текстовые посты канала за последние hours часов, от новых к старым"""
+    # При догрузке по min_id - без лимита, это только новые посты
+    posts = []
+    time_threshold = datetime.now(timezone.utc) - timedelta(hours=hours)
+    
+    async for message in client.iter_messages(channel, limit=None if min_id else HISTORY_LIMIT, min_id=min_id):
+        if message.date < time_threshold:
+            break
+            
+        if message.text and len(message.text.strip()) > 0:
+            posts.append((message.id, message.date, message.text))
+    
+    logger.info(f"Получено {len(posts)} постов из канала {channel_link}")
+    return posts
+
+def backfill_partitions(since: datetime, until: datetime) -> list:
+    """Диапазоны [start, end), выровненные по BACKFILL_PARTITION_HOURS от начала эпохи,
+    чтобы разные запуски попадали в одни и те же диапазоны"""
+    step = BACKFILL_PARTITION_HOURS * 3600
+    start = int(since.timestamp()) // step * step
+    partitions = []
+    while start < until.timestamp():
+        partitions.append((datetime.fromtimestamp(start, timezone.utc),
+                           datetime.fromtimestamp(start + step, timezone.utc)))
+        start += step
+    return partitions
+
+async def backfill_channel(channel_link: str, since: datetime) -> list:
+    """Выгружаем историю канала с since по диапазонам параллельно и отдаем из bot.db.
+    None - ни один диапазон получить не удалось"""
+    from telethon.errors import FloodWaitError
+    
+    key = channel_link.lower()
+    now = datetime.now(timezone.utc)
+    parallel = asyncio.Semaphore(BACKFILL_PARALLEL)
+    pool = get_client_pool()
+    # Канал резолвится один раз на аккаунт, а не в каждом диапазоне:
+    # ResolveUsername - самый ограниченный по FloodWait метод
+    entities = {}
+    resolving = asyncio.Lock()
+    
+    async def resolve(account):
+        async with resolving:
+            if account.name not in entities:
+                entities[account.name] = await account.client.get_input_entity(channel_link)
+        return entities[account.name]
+    
+    async def fetch_partition(part_start: datetime, part_end: datetime):
+        start_key, end_key = part_start.isoformat(), part_end.isoformat()
+        progress = load_backfill_partition(key, start_key, end_key)
+        if progress and progress[1]:
+            return True
+        async with parallel:
+            tried = set()
+            while True:
+                account = await pool.acquire(channel_link, exclude=tried)
+                if account is None:
+                    return False
+                try:
+                    # Продолжаем с самого старого уже сохраненного поста диапазона
+                    progress = load_backfill_partition(key, start_key, end_key)
+                    oldest_id = progress[0] if progress else None
+                    entity = await resolve(account)
+                    batch = []
+                    kwargs = {'max_id': oldest_id} if oldest_id else {'offset_date': part_end}
+                    # Первую страницу оплатил pool.acquire, каждая следующая - токен из бюджета аккаунта
+                    received = 0
+                    async for message in account.client.iter_messages(entity, limit=None, wait_time=0, **kwargs):
+                        if message.date < part_start:
+                            break
+                        received += 1
+                        if received % HISTORY_PAGE_SIZE == 0:
+                            await account.bucket.acquire()
+                        oldest_id = message.id
+                        if message.text and message.text.strip():
+                            batch.append((message.id, message.date, message.text))
+                        if len(batch) >= BACKFILL_BATCH:
+                            save_backfill_batch(key, start_key, end_key, batch, oldest_id, False)
+                            batch = []
+                    # Диапазон, который еще не закончился, в следующий раз качаем снова с начала
+                    save_backfill_batch(key, start_key, end_key, batch, None, part_end <= now)
+                    return True
+                except FloodWaitError as e:
+                    FLOOD_WAITS.inc(account=account.name)
+                    FLOOD_WAIT_SECONDS.inc(e.seconds, account=account.name)
+                    pool.report_flood(account, e.seconds)
+                    if account.name in tried:
+                        return False
+                    tried.add(account.name)
+                except Exception as e:
+                    logger.error(f"Ошибка выгрузки {channel_link} за {start_key}..{end_key}: {str(e)}")
+                    return False
+    
+    if not is_valid_channel(channel_link):
+        logger.error(f"Невалидная ссылка на канал: {channel_link}")
+        return None
+    
+    partitions = backfill_partitions(since, now)
+    account = await pool.acquire(channel_link)
+    if account is not None:
+        try:
+            await resolve(account)
+        except FloodWaitError as e:
+            FLOOD_WAITS.inc(account=account.name)
+            FLOOD_WAIT_SECONDS.inc(e.seconds, account=account.name)
+            pool.report_flood(account, e.seconds)
+        except Exception as e:
+            logger.error(f"Не удалось получить доступ к каналу {channel_link}: {str(e)}")
+            return None
+    with span('backfill'):
+        results = await asyncio.gather(*(fetch_partition(start, end) for start, end in partitions))
+    if not any(results):
+        logger.error(f"Не удалось выгрузить ни один диапазон канала {channel_link}")
+        return None
+    if not all(results):
+        logger.warning(f"Выгружено {sum(results)} из {len(results)} диапазонов канала {channel_link}")
+    messages = load_channel_posts(key, since)
+    logger.info(f"Получено {len(messages)} постов из канала {channel_link} за {len(partitions)} диапазонов")
+    return messages
+
+def posts_retention_hours() -> int:
+    return POSTS_RETENTION_HOURS or max(ANALYSIS_WINDOWS) + BACKFILL_PARTITION_HOURS
+
+def prune_stored_posts():
+    """Чистка bot.db от постов, которые уже не попадут ни в одно окно анализа"""
+    removed = prune_channel_posts(datetime.now(timezone.utc) - timedelta(hours=posts_retention_hours()))
+    if removed:
+        logger.info(f"Удалено устаревших сохраненных постов: {removed}")
+
+async def on_new_channel_message(event):
+    """Новый пост в отслеживаемом канале - кладем в буфер"""
+    key = post_buffer.channel_ids.get(event.chat_id)
+    if key and event.message.text and event.message.text.strip():
+        message = (event.message.id, event.message.date, event.message.text)
+        post_buffer.add(key, [message])
+        share_buffer(key, [message])
+
+def ingestion_channels() -> set:
+    """Объединение каналов из папок всех пользователей"""
+    channels = set()
+    # Читаем user_data.json заново: в процессе-воркере данные в памяти могут устареть
+    for user in UserData.load().users.values():
+        for folder_channels in user['folders'].values():
+            channels.update(post_buffer.key(ch) for ch in folder_channels if is_valid_channel(ch))
+    return channels
+
+async def refresh_ingestion_channels():
+    """Подписываемся на новые каналы из папок и забываем удаленные"""
+    wanted = ingestion_channels()
+    for key in list(post_buffer.covered_since):
+        if key not in wanted:
+            post_buffer.forget(key)
+            if ANALYSIS_WORKERS:
+                clear_ingest_state(key)
+    for channel in sorted(wanted - set(post_buffer.covered_since)):
+        # Первая выгрузка резолвит канал, вступает в него и заполняет буфер
+        await get_channel_messages(channel, INGEST_WINDOW_HOURS)
+    logger.info(f"Фоновое получение постов: {len(wanted)} каналов")
+
+def start_ingestion():
+    """Вешаем обработчик NewMessage на все аккаунты пула и периодически обновляем список каналов"""
+    from telethon import events
+    global ingestion_running
+    
+    ingestion_running = True
+    if ANALYSIS_WORKERS:
+        # Пока процесс не слушал события, посты могли пройти мимо: общий буфер заполняется заново
+        clear_ingest_state()
+    for account in get_client_pool().accounts:
+        if account.authorized:
+            account.client.add_event_handler(on_new_channel_message, events.NewMessage())
+    scheduler.add_job(refresh_ingestion_channels, 'interval', minutes=INGEST_REFRESH_MINUTES,
+                      id='refresh_ingestion', replace_existing=True, next_run_time=datetime.now(pytz.UTC))
 
 @dp.message_handler(lambda message: message.text == "📊 История отчетов")
 async def show_reports(message: types.Message):
@@ -800,33 +2531,180 @@ async def show_reports(message: types.Message):
         return
         
     text = "📊 Последние отчеты:\n\n"
-    for folder, content, created_at in reports:
+    for _, folder, content, created_at in reports:
         dt = datetime.fromisoformat(created_at.replace('Z', '+00:00'))
         text += f"📁 {folder} ({dt.strftime('%Y-%m-%d %H:%M')})\n"
         
     keyboard = types.InlineKeyboardMarkup(row_width=1)
-    for folder, _, _ in reports:
+    for report_id, folder, _, created_at in reports:
         keyboard.add(types.InlineKeyboardButton(
-            f"📄 Отчет по {folder}",
-            callback_data=f"report_{folder}"
+            f"📄 Отчет по {folder} ({created_at[:16]})",
+            callback_data=f"report_{report_id}"
         ))
         
     await message.answer(text, reply_markup=keyboard)
 
 @dp.callback_query_handler(lambda c: c.data.startswith('report_'))
 async def show_report_content(callback_query: types.CallbackQuery):
-    folder = callback_query.data.replace('report_', '')
-    reports = get_user_reports(callback_query.from_user.id)
-    
-    for rep_folder, content, created_at in reports:
-        if rep_folder == folder:
-            dt = datetime.fromisoformat(created_at.replace('Z', '+00:00'))
-            await callback_query.message.answer(
-                f"📊 Отчет по папке {folder}\n"
-                f"📅 {dt.strftime('%Y-%m-%d %H:%M')}\n\n"
-                f"{content}"
-            )
-            break
+    report_id = callback_query.data.replace('report_', '')
+    report = get_report(callback_query.from_user.id, int(report_id)) if report_id.isdigit() else None
+    if report is None:
+        await callback_query.answer("Отчет не найден")
+        return
+    
+    folder, content, created_at = report
+    dt = datetime.fromisoformat(created_at.replace('Z', '+00:00'))
+    keyboard = types.InlineKeyboardMarkup(row_width=2)
+    keyboard.add(
+        types.InlineKeyboardButton("📄 TXT", callback_data=f"rfile:{report_id}:txt"),
+        types.InlineKeyboardButton("📑 PDF", callback_data=f"rfile:{report_id}:pdf")
+    )
+    await callback_query.message.answer(
+        f"📊 Отчет по папке {folder}\n"
+        f"📅 {dt.strftime('%Y-%m-%d %H:%M')}\n\n"
+        f"{content}"[:MESSAGE_LIMIT],
+        reply_markup=keyboard
+    )
+    await callback_query.answer()
+
+@dp.callback_query_handler(lambda c: c.data.startswith('rfile:'))
+async def send_history_report_file(callback_query: types.CallbackQuery):
+    _, report_id, format_type = callback_query.data.split(':')
+    report = get_report(callback_query.from_user.id, int(report_id))
+    if report is None or format_type not in REPORT_RENDERERS:
+        await callback_query.answer("Отчет не найден")
+        return
+    await callback_query.answer()
+    folder, content, _ = report
+    try:
+        await send_report_file(callback_query.message.chat.id, int(report_id), folder, content, format_type)
+    except Exception as e:
+        logger.error(f"Ошибка при отправке файла отчета {report_id}: {str(e)}")
+        await callback_query.message.answer(f"❌ Не удалось отправить файл отчета: {str(e)}")
+
+# Последний запрос /search пользователя: в callback_data (64 байта) запрос не помещается
+search_queries = {}
+
+def highlight_snippet(snippet: str) -> str:
+    """Экранируем сниппет для HTML и подсвечиваем совпадения"""
+    text = snippet.replace('\n', ' ').replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+    return text.replace('\x02', '<b>').replace('\x03', '</b>')
+
+def render_search_page(user_id: int, scope: str, page: int):
+    """Текст и клавиатура страницы результатов поиска по отчетам или постам"""
+    query = search_queries.get(user_id)
+    if scope == 'posts':
+        user = user_data.get_user_data(user_id)
+        channels = sorted({channel for channels in user['folders'].values() for channel in channels})
+        rows = search_posts(channels, query, SEARCH_PAGE_SIZE + 1, page * SEARCH_PAGE_SIZE)
+        lines = [f"📰 {channel} ({date[:16].replace('T', ' ')})\n{highlight_snippet(snippet)}"
+                 for channel, _, date, snippet in rows[:SEARCH_PAGE_SIZE]]
+    else:
+        rows = search_reports(user_id, query, SEARCH_PAGE_SIZE + 1, page * SEARCH_PAGE_SIZE)
+        lines = [f"📁 {folder} ({created_at[:16]})\n{highlight_snippet(snippet)}"
+                 for _, folder, created_at, snippet in rows[:SEARCH_PAGE_SIZE]]
+    
+    where = "постах" if scope == 'posts' else "отчетах"
+    if lines:
+        text = f"🔎 «{highlight_snippet(query)}» в {where}, стр. {page + 1}:\n\n" + "\n\n".join(lines)
+    else:
+        text = f"🔎 По запросу «{highlight_snippet(query)}» в {where} ничего не найдено"
+    
+    keyboard = types.InlineKeyboardMarkup()
+    navigation = []
+    if page > 0:
+        navigation.append(types.InlineKeyboardButton("⬅️", callback_data=f"search:{scope}:{page - 1}"))
+    if len(rows) > SEARCH_PAGE_SIZE:
+        navigation.append(types.InlineKeyboardButton("➡️", callback_data=f"search:{scope}:{page + 1}"))
+    if navigation:
+        keyboard.row(*navigation)
+    other = 'reports' if scope == 'posts' else 'posts'
+    keyboard.add(types.InlineKeyboardButton(
+        "🔎 Искать в отчетах" if other == 'reports' else "🔎 Искать в постах",
+        callback_data=f"search:{other}:0"
+    ))
+    return text, keyboard
+
+@dp.message_handler(commands=['search'])
+async def cmd_search(message: types.Message):
+    query = message.get_args().strip()
+    if not search_enabled:
+        await message.answer("❌ Поиск недоступен: SQLite собран без FTS5")
+        return
+    if not fts_query(query):
+        await message.answer("Использование: /search слова для поиска")
+        return
+    search_queries[message.from_user.id] = query
+    text, keyboard = render_search_page(message.from_user.id, 'reports', 0)
+    await message.answer(text, reply_markup=keyboard, parse_mode='HTML')
+
+@dp.callback_query_handler(lambda c: c.data.startswith('search:'))
+async def process_search_page(callback_query: types.CallbackQuery):
+    _, scope, page = callback_query.data.split(':')
+    if callback_query.from_user.id not in search_queries:
+        await callback_query.answer("Запрос устарел, повторите /search")
+        return
+    text, keyboard = render_search_page(callback_query.from_user.id, scope, int(page))
+    await callback_query.message.edit_text(text, reply_markup=keyboard, parse_mode='HTML')
+    await callback_query.answer()
+
+EXPORT_USAGE = (
+    "Использование: /export [jsonl|csv|txt] [from=ГГГГ-ММ-ДД] [to=ГГГГ-ММ-ДД] [folder=папка]\n"
+    "Например: /export csv from=2024-01-01 folder=Новости"
+)
+
+@dp.message_handler(commands=['export'])
+async def cmd_export(message: types.Message):
+    """Ставим в очередь выгрузку архива отчетов пользователя"""
+    payload = {'format': 'jsonl'}
+    try:
+        for arg in message.get_args().split():
+            key, _, value = arg.partition('=')
+            if not value and key.lower() in EXPORT_FORMATS:
+                payload['format'] = key.lower()
+            elif key == 'from':
+                payload['since'] = datetime.strptime(value, '%Y-%m-%d').strftime('%Y-%m-%d')
+            elif key == 'to':
+                # Дата включительно: берем все до начала следующего дня
+                payload['until'] = (datetime.strptime(value, '%Y-%m-%d') + timedelta(days=1)).strftime('%Y-%m-%d')
+            elif key == 'folder':
+                payload['folder'] = value
+            else:
+                raise ValueError(arg)
+    except ValueError:
+        await message.answer(EXPORT_USAGE)
+        return
+    
+    job_id = enqueue_job('export', message.from_user.id, message.chat.id, payload)
+    logger.info(f"Экспорт отчетов пользователя {message.from_user.id} поставлен в очередь (задача {job_id})")
+    await message.answer("📦 Готовлю архив отчетов, пришлю файлами, когда будет готов")
+
+ADMIN_IDS = {int(user_id) for user_id in os.getenv('ADMIN_IDS', '').split(',') if user_id.strip()}
+
+@dp.message_handler(commands=['profile'])
+async def cmd_profile(message: types.Message):
+    """Профилирование процесса бота на N секунд (только для ADMIN_IDS)"""
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    args = message.get_args().strip()
+    seconds = int(args) if args.isdigit() else 10
+    seconds = max(1, min(seconds, PROFILE_MAX_SECONDS))
+    if not profile_lock.acquire(blocking=False):
+        await message.answer("⏳ Профайлер уже запущен")
+        return
+    try:
+        await message.answer(f"🔬 Снимаю профиль {seconds} с...")
+        loop = asyncio.get_event_loop()
+        counts = await loop.run_in_executor(None, sample_stacks, seconds)
+        filename = write_collapsed_stacks(counts)
+    finally:
+        profile_lock.release()
+    try:
+        await outbound.send_documents(message.chat.id, [(
+            filename, f"🔬 Профиль за {seconds} с: {sum(counts.values())} семплов (collapsed stacks)", None
+        )])
+    finally:
+        os.remove(filename)
 
 @dp.message_handler(lambda message: message.text == "⏰ Настроить расписание")
 async def setup_schedule_start(message: types.Message):
@@ -915,44 +2793,18 @@ async def process_schedule_time(message: types.Message, state: FSMContext):
     )
 
 async def run_scheduled_analysis(user_id: int, folder: str):
-    """Запуск анализа по расписанию"""
-    try:
-        user = user_data.get_user_data(user_id)
-        channels = user['folders'][folder]
-        
-        all_posts = []
-        for channel in channels:
-            if not is_valid_channel(channel):
-                continue
-                
-            posts = await get_channel_posts(channel)
-            if posts:
-                all_posts.extend(posts)
-                
-        if not all_posts:
-            logger.error(f"Не удалось получить посты для автоматического анализа папки {folder}")
-            return
-            
-        posts_text = "\n\n---\n\n".join(all_posts)
-        prompt = user['prompts'][folder]
-        
-        response = await try_gpt_request(prompt, posts_text, user_id)
-        
-        # Сохраняем отчет
-        save_report(user_id, folder, response)
-        
-        # Логируем успешное завершение отчета
-        logger.info("отчет удался")
-        
-        # Отправляем уведомление пользователю
-        await bot.send_message(
-            user_id,
-            f"✅ Автоматический анализ папки {folder} завершен!\n"
-            f"Используйте '📊 История отчетов' чтобы просмотреть результат."
-        )
-        
-    except Exception as e:
-        logger.error(f"Ошибка при автоматическом анализе: {str(e)}")
+    """Запуск анализа по расписанию: ставим задачу в очередь"""
+    user = user_data.get_user_data(user_id)
+    if folder not in user['folders']:
+        logger.error(f"Папка {folder} для автоматического анализа не найдена")
+        return
+    job_id = enqueue_job('scheduled', user_id, user_id, {
+        'folders': [[folder, user['folders'][folder], user['prompts'][folder]]],
+        'model': user['ai_settings']['model'],
+        'provider_index': user['ai_settings']['provider_index'],
+        'budget': SCHEDULED_BUDGET_SECONDS,
+    })
+    logger.info(f"Автоматический анализ папки {folder} поставлен в очередь (задача {job_id})")
 
 @dp.message_handler(lambda message: message.text == "🔄 Запустить анализ")
 async def start_analysis(message: types.Message):
@@ -1007,18 +2859,11 @@ async def choose_format(callback_query: types.CallbackQuery):
     folder = callback_query.data.replace('format_', '')
     
     keyboard = types.InlineKeyboardMarkup(row_width=2)
-    if folder == 'all':
-        keyboard.add(
-            types.InlineKeyboardButton("📝 TXT", callback_data="analyze_all_txt"),
-            types.InlineKeyboardButton("📊 PDF", callback_data="analyze_all_pdf"),
-            types.InlineKeyboardButton("📎 Оба формата", callback_data="analyze_all_both")
-        )
-    else:
-        keyboard.add(
-            types.InlineKeyboardButton("📝 TXT", callback_data=f"analyze_{folder}_txt"),
-            types.InlineKeyboardButton("📊 PDF", callback_data=f"analyze_{folder}_pdf"),
-            types.InlineKeyboardButton("📎 Оба формата", callback_data=f"analyze_{folder}_both")
-        )
+    keyboard.add(
+        types.InlineKeyboardButton("📝 TXT", callback_data=f"period_{folder}_txt"),
+        types.InlineKeyboardButton("📊 PDF", callback_data=f"period_{folder}_pdf"),
+        types.InlineKeyboardButton("📎 Оба формата", callback_data=f"period_{folder}_both")
+    )
     
     keyboard.add(types.InlineKeyboardButton("🔙 Назад", callback_data="back_to_folders"))
     
@@ -1027,81 +2872,651 @@ async def choose_format(callback_query: types.CallbackQuery):
         reply_markup=keyboard
     )
 
+# Окна анализа в часах
+ANALYSIS_WINDOWS = {24: "24 часа", 168: "7 дней", 720: "30 дней"}
+
+@dp.callback_query_handler(lambda c: c.data.startswith('period_'))
+async def choose_period(callback_query: types.CallbackQuery):
+    folder, format_type = callback_query.data.replace('period_', '', 1).rsplit('_', 1)
+    
+    keyboard = types.InlineKeyboardMarkup(row_width=3)
+    keyboard.add(*[
+        types.InlineKeyboardButton(f"🗓 {title}", callback_data=f"analyze_{folder}_{format_type}_{hours}")
+        for hours, title in ANALYSIS_WINDOWS.items()
+    ])
+    keyboard.add(types.InlineKeyboardButton("🔙 Назад", callback_data=f"format_{folder}"))
+    
+    await callback_query.message.edit_text("За какой период анализировать посты?", reply_markup=keyboard)
+
 @dp.callback_query_handler(lambda c: c.data.startswith('analyze_'))
 async def process_analysis_choice(callback_query: types.CallbackQuery):
-    # Парсим параметры из callback_data
+    # Парсим параметры из callback_data (окно в часах - необязательный третий параметр)
     params = callback_query.data.replace('analyze_', '').split('_')
-    if len(params) != 2:
+    hours = 24
+    if len(params) == 3 and params[2].isdigit():
+        hours = int(params.pop())
+    if len(params) != 2 or hours not in ANALYSIS_WINDOWS:
         await callback_query.message.answer("❌ Ошибка в параметрах анализа")
         return
         
     choice, format_type = params
     user = user_data.get_user_data(callback_query.from_user.id)
     
-    await callback_query.message.edit_text("Начинаю анализ... Это может занять некоторое время")
-    
     if choice == 'all':
-        folders = user['folders'].items()
+        folders = list(user['folders'].items())
     else:
         folders = [(choice, user['folders'][choice])]
     
-    for folder, channels in folders:
-        await callback_query.message.answer(f"Анализирую папку {folder}...")
-        
-        all_posts = []
-        for channel in channels:
+    # Сам анализ выполняют воркеры, здесь только ставим задачу с копией настроек
+    job_id = enqueue_job('analysis', callback_query.from_user.id, callback_query.message.chat.id, {
+        'folders': [[folder, channels, user['prompts'][folder]] for folder, channels in folders],
+        'format': format_type,
+        'hours': hours,
+        'model': user['ai_settings']['model'],
+        'provider_index': user['ai_settings']['provider_index'],
+        'budget': ANALYSIS_BUDGET_SECONDS * (2 if hours > 24 else 1),
+    })
+    logger.info(f"Анализ {choice} ({format_type}, {hours} ч) для пользователя {callback_query.from_user.id} поставлен в очередь (задача {job_id})")
+    
+    await callback_query.message.edit_text("Начинаю анализ... Это может занять некоторое время")
+
+# Нормализация постов перед запросом к ИИ: ссылки, эмодзи, хэштеги, пробелы
+# и строки-подписи, которые канал повторяет почти в каждом посте
+NORMALIZE_POSTS = os.getenv('NORMALIZE_POSTS', '1') == '1'
+NORMALIZE_URLS = os.getenv('NORMALIZE_URLS', '1') == '1'
+NORMALIZE_HASHTAGS = os.getenv('NORMALIZE_HASHTAGS', 'strip')  # keep, strip (убрать #) или drop
+BOILERPLATE_MIN_POSTS = int(os.getenv('BOILERPLATE_MIN_POSTS', '4'))
+BOILERPLATE_MIN_SHARE = float(os.getenv('BOILERPLATE_MIN_SHARE', '0.5'))
+POST_CHAR_BUDGET = int(os.getenv('POST_CHAR_BUDGET', '0'))  # 0 - не обрезать
+
+URL_RE = re.compile(r'https?://(?:www\.)?([^\s/]+)(/\S*)?')
+EMOJI_RUN_RE = re.compile(r'([\U0001F000-\U0001FAFF\u2600-\u27BF\u2B00-\u2BFF])'
+                          r'(?:[\U0001F000-\U0001FAFF\u2600-\u27BF\u2B00-\u2BFF\uFE0F\u200D]|[\U0001F3FB-\U0001F3FF])+')
+HASHTAG_RE = re.compile(r'(?<!\w)#(\w+)')
+HASHTAG_LINE_RE = re.compile(r'^(?:#\w+[\s,.]*)+$')
+SPACES_RE = re.compile(r'[ \t\u00A0\u200B]+')
+
+# Выученные подписи каналов: {канал: set(строк)}, нужны, когда новых постов мало (дельта-анализ)
+channel_boilerplate = {}
+
+def estimate_tokens(text_length: int) -> int:
+    """Грубая оценка токенов: около 4 символов на токен"""
+    return (text_length + 3) // 4
+
+def boilerplate_key(line: str) -> str:
+    return SPACES_RE.sub(' ', line).strip().lower()
+
+def learn_boilerplate(channel: str, texts: list) -> set:
+    """Строки, которые встречаются в заметной доле постов канала, считаем подписью или рекламой"""
+    key = channel.lower()
+    if len(texts) < BOILERPLATE_MIN_POSTS:
+        return channel_boilerplate.get(key, set())
+    seen = {}
+    for text in texts:
+        for line in {boilerplate_key(line) for line in text.splitlines()}:
+            if line:
+                seen[line] = seen.get(line, 0) + 1
+    boilerplate = {line for line, count in seen.items() if count >= max(2, len(texts) * BOILERPLATE_MIN_SHARE)}
+    channel_boilerplate[key] = boilerplate
+    return boilerplate
+
+def shorten_url(match) -> str:
+    host, path = match.group(1), match.group(2)
+    return f"{host}/…" if path and path != '/' else host
+
+def normalize_post(text: str, boilerplate: set) -> str:
+    """Чистим один пост; пустая строка - в посте не осталось ничего, кроме шума"""
+    lines = []
+    for line in text.splitlines():
+        if boilerplate_key(line) in boilerplate:
+            continue
+        if NORMALIZE_HASHTAGS != 'keep' and HASHTAG_LINE_RE.match(line.strip()):
+            continue
+        if NORMALIZE_URLS:
+            line = URL_RE.sub(shorten_url, line)
+        if NORMALIZE_HASHTAGS == 'strip':
+            line = HASHTAG_RE.sub(r'\1', line)
+        elif NORMALIZE_HASHTAGS == 'drop':
+            line = HASHTAG_RE.sub('', line)
+        line = EMOJI_RUN_RE.sub(r'\1', line)
+        lines.append(SPACES_RE.sub(' ', line).strip())
+    text = re.sub(r'\n{3,}', '\n\n', "\n".join(lines)).strip()
+    if POST_CHAR_BUDGET and len(text) > POST_CHAR_BUDGET:
+        cut = text.rfind(' ', 0, POST_CHAR_BUDGET)
+        text = text[:cut if cut > POST_CHAR_BUDGET // 2 else POST_CHAR_BUDGET].rstrip() + "…"
+    return text
+
+def normalize_channel_messages(channel: str, messages: list) -> list:
+    """Нормализуем посты канала [(id, date, text)], пустые после очистки выбрасываем"""
+    boilerplate = learn_boilerplate(channel, [text for _, _, text in messages])
+    normalized = []
+    for message_id, date, text in messages:
+        text = normalize_post(text, boilerplate)
+        if text:
+            normalized.append((message_id, date, text))
+    return normalized
+
+async def fetch_folder_messages(channels: list, folder: str, warnings: list = None, since: datetime = None,
+                                hours: int = 24, checkpoints: Checkpoints = None, failed: list = None) -> dict:
+    """Собираем посты каналов папки: {канал: [(id, date, text)]}, при since - только более новые.
+    В warnings попадают каналы без постов, в failed - каналы, которые не удалось прочитать"""
+    by_channel = {}
+    raw_chars = clean_chars = 0
+    with span('fetch', folder=folder):
+        for position, channel in enumerate(channels):
             if not is_valid_channel(channel):
                 continue
-                
-            posts = await get_channel_posts(channel)
-            if posts:
-                all_posts.extend(posts)
+            
+            # Посты канала, уже полученные до рестарта, берем из чекпоинта
+            checkpoint_key = f"{folder}/{channel}"
+            saved = checkpoints.get('posts', checkpoint_key) if checkpoints else None
+            if saved is not None:
+                messages = [(m[0], datetime.fromisoformat(m[1]), m[2]) for m in saved]
             else:
-                await callback_query.message.answer(f"⚠️ Не удалось получить посты из канала {channel}")
+                # Время на ИИ оставляем: при нехватке анализируем то, что успели собрать
+                try:
+                    messages = await within_deadline(get_channel_messages(channel, hours), 'сбор постов',
+                                                     reserve=DEADLINE_LLM_RESERVE)
+                except DeadlineExceeded:
+                    skipped = [c for c in channels[position:] if is_valid_channel(c)]
+                    logger.warning(f"Бюджет времени на сбор постов папки {folder} исчерпан, "
+                                   f"пропущено каналов: {len(skipped)}")
+                    if warnings is not None:
+                        warnings.extend(skipped)
+                    if failed is not None:
+                        failed.extend(skipped)
+                    break
+                if messages is None:
+                    if failed is not None:
+                        failed.append(channel)
+                if messages and checkpoints:
+                    checkpoints.set('posts', checkpoint_key, [[m[0], m[1].isoformat(), m[2]] for m in messages])
+            if messages:
+                fresh = [m for m in messages if since is None or m[1] > since]
+                if fresh and NORMALIZE_POSTS:
+                    raw_chars += sum(len(text) for _, _, text in fresh)
+                    fresh = normalize_channel_messages(channel, fresh)
+                    clean_chars += sum(len(text) for _, _, text in fresh)
+                if fresh:
+                    by_channel[channel] = fresh
+            elif warnings is not None:
+                warnings.append(channel)
+    if raw_chars:
+        POST_CHARS.inc(raw_chars, stage='raw')
+        POST_CHARS.inc(clean_chars, stage='normalized')
+        logger.info(f"Нормализация постов папки {folder}: {raw_chars} -> {clean_chars} символов "
+                    f"(~{estimate_tokens(raw_chars)} -> ~{estimate_tokens(clean_chars)} токенов)")
+    return by_channel
+
+def flatten_messages(by_channel: dict) -> list:
+    return [m for messages in by_channel.values() for m in messages]
+
+# Выжимки каналов (CHANNEL_DIGESTS=1): популярный канал из сотен папок
+# отправляется провайдеру один раз, а папки получают уже сжатый текст.
+# Выжимка устаревает, как только в канале появляется пост новее last_post_id
+CHANNEL_DIGESTS = os.getenv('CHANNEL_DIGESTS', '0') == '1'
+DIGEST_MIN_CHARS = int(os.getenv('DIGEST_MIN_CHARS', '1500'))  # короткие каналы идут как есть
+DIGEST_MAX_AGE_MINUTES = int(os.getenv('DIGEST_MAX_AGE_MINUTES', '60'))
+DIGEST_PARALLEL = int(os.getenv('DIGEST_PARALLEL', '4'))  # выжимок одной папки считается одновременно
+DIGEST_PROMPT = (
+    "Сожми посты канала в краткую выжимку: перечисли все значимые события, факты, "
+    "цифры и мнения без потери смысла. Не добавляй оценок и выводов от себя."
+)
+_digest_locks = {}
+
+async def get_channel_digest(channel: str, messages: list, window_hours: int, user_id: int,
+                             model: str = None, provider_index: int = None) -> str:
+    """Выжимка канала из bot.db или новая, если в канале появились посты"""
+    key = channel.lower()
+    newest_id = max(m[0] for m in messages)
+    
+    def cached():
+        row = load_channel_digest(key, window_hours)
+        if row and row[0] == newest_id and row[2] < DIGEST_MAX_AGE_MINUTES * 60:
+            return row[1]
+        return None
+    
+    digest = cached()
+    if digest is not None:
+        CACHE_HITS.inc(cache='channel_digest')
+        return digest
+    
+    # Одновременно выжимку одного канала считает только одна задача
+    lock = _digest_locks.setdefault(key, asyncio.Lock())
+    async with lock:
+        digest = cached()
+        if digest is not None:
+            CACHE_HITS.inc(cache='channel_digest')
+            return digest
+        CACHE_MISSES.inc(cache='channel_digest')
+        posts_text = "\n\n---\n\n".join(text for _, _, text in messages)
+        with span('digest'):
+            digest = await try_gpt_request(DIGEST_PROMPT, posts_text, user_id, model=model,
+                                           provider_index=provider_index)
+        save_channel_digest(key, window_hours, newest_id, len(messages), digest)
+        return digest
+
+async def build_posts_text(by_channel: dict, user_id: int, payload: dict, window_hours: int = 24) -> str:
+    """Текст для запроса по папке: посты как есть или выжимки каналов"""
+    if not CHANNEL_DIGESTS:
+        return "\n\n---\n\n".join(text for _, _, text in flatten_messages(by_channel))
+    parallel = asyncio.Semaphore(DIGEST_PARALLEL)
+    
+    async def channel_part(channel: str, messages: list) -> str:
+        raw = "\n\n---\n\n".join(text for _, _, text in messages)
+        if len(raw) < DIGEST_MIN_CHARS:
+            return f"Канал {channel}:\n{raw}"
+        try:
+            async with parallel:
+                digest = await get_channel_digest(channel, messages, window_hours, user_id,
+                                                  payload.get('model'), payload.get('provider_index'))
+            return f"Канал {channel} (выжимка {len(messages)} постов):\n{digest}"
+        except Exception as e:
+            logger.warning(f"Не удалось получить выжимку канала {channel}, отправляю посты: {str(e)}")
+            return f"Канал {channel}:\n{raw}"
+    
+    # Выжимки каналов считаются параллельно; порядок каналов в запросе сохраняется
+    parts = await asyncio.gather(*(channel_part(channel, messages) for channel, messages in by_channel.items()))
+    return "\n\n=====\n\n".join(parts)
+
+def newest_post_date(messages: list):
+    """Дата самого нового поста (cutoff для следующего дельта-анализа)"""
+    return max((m[1] for m in messages), default=None)
+
+# Дельта-анализ по расписанию: в запрос идут только посты новее прошлого отчета
+# и сам прошлый отчет, а не все посты за сутки заново
+DELTA_ANALYSIS = os.getenv('DELTA_ANALYSIS', '1') == '1'
+# Прошлый отчет годится для дельты, если его cutoff не старше этого; ежедневное
+# расписание дает разрыв чуть больше суток, поэтому по умолчанию 48 часов
+DELTA_MAX_AGE_HOURS = int(os.getenv('DELTA_MAX_AGE_HOURS', '48'))
+DELTA_PROMPT = (
+    "Ниже твой предыдущий отчет по этим каналам. В данных для анализа - только посты, "
+    "вышедшие после него. Обнови отчет: добавь новое, убери устаревшее, сохрани структуру "
+    "и верни отчет целиком.\n\nПредыдущий отчет:\n{previous}"
+)
+
+def build_delta_prompt(prompt: str, previous_report: str) -> str:
+    return f"{prompt}\n\n{DELTA_PROMPT.format(previous=previous_report)}"
+
+# Пакетный анализ (BATCH_FOLDERS=1): несколько маленьких папок, каждая со своим промптом,
+# уходят провайдеру одним запросом, а ответ делится обратно по меткам разделов.
+# Папка, для которой раздел не нашелся, анализируется отдельным запросом
+BATCH_FOLDERS = os.getenv('BATCH_FOLDERS', '1') == '1'
+BATCH_FOLDER_MAX_CHARS = int(os.getenv('BATCH_FOLDER_MAX_CHARS', '6000'))  # больше - отдельный запрос
+BATCH_MAX_CHARS = int(os.getenv('BATCH_MAX_CHARS', '24000'))
+BATCH_MAX_FOLDERS = int(os.getenv('BATCH_MAX_FOLDERS', '6'))
+BATCH_PROMPT = (
+    "Ниже несколько независимых заданий, у каждого свой промпт и свои данные. "
+    "Выполни каждое задание отдельно. Ответ на каждое задание начни отдельной строкой "
+    "вида «=== ОТЧЕТ F1 ===» с меткой этого задания, без текста до первой метки."
+)
+BATCH_SECTION_RE = re.compile(r'^\W*=+\s*ОТЧЕТ\s+(F\d+)\s*=+\W*$', re.MULTILINE)
+
+def pack_folder_batches(sizes: dict) -> list:
+    """Раскладываем маленькие папки {папка: символов} по пакетам; в пакете минимум две папки"""
+    batches = []
+    current, current_size = [], 0
+    for folder, size in sizes.items():
+        if size > BATCH_FOLDER_MAX_CHARS:
+            continue
+        if current and (current_size + size > BATCH_MAX_CHARS or len(current) >= BATCH_MAX_FOLDERS):
+            batches.append(current)
+            current, current_size = [], 0
+        current.append(folder)
+        current_size += size
+    batches.append(current)
+    return [batch for batch in batches if len(batch) > 1]
+
+def split_batch_response(response: str, labels: list) -> dict:
+    """Делим ответ по меткам: {метка: отчет}, пустые и неизвестные разделы отбрасываем"""
+    parts = BATCH_SECTION_RE.split(response)
+    sections = {}
+    for label, text in zip(parts[1::2], parts[2::2]):
+        if label in labels and text.strip() and label not in sections:
+            sections[label] = text.strip()
+    return sections
+
+async def run_folder_batches(payload: dict, fetched: dict, posts_texts: dict, user_id: int, hours: int,
+                             checkpoints: Checkpoints):
+    """Анализируем маленькие папки пакетами; готовые отчеты сразу идут в чекпоинты"""
+    prompts = {folder: prompt for folder, _, prompt in payload['folders']}
+    for folder, by_channel in fetched.items():
+        posts_texts[folder] = await build_posts_text(by_channel, user_id, payload, hours)
+    
+    for batch in pack_folder_batches({folder: len(text) for folder, text in posts_texts.items()}):
+        labels = {f"F{i + 1}": folder for i, folder in enumerate(batch)}
+        tasks = "\n\n".join(
+            f"=== ЗАДАНИЕ {label} (папка {folder}) ===\nПромпт:\n{prompts[folder]}\n\n"
+            f"Данные для анализа:\n{posts_texts[folder]}"
+            for label, folder in labels.items()
+        )
+        try:
+            with span('llm_batch', folders=len(batch)):
+                response = await try_gpt_request(BATCH_PROMPT, tasks, user_id, model=payload['model'],
+                                                 provider_index=payload.get('provider_index'))
+        except Exception as e:
+            logger.warning(f"Пакетный запрос по папкам {', '.join(batch)} не удался, анализирую по одной: {str(e)}")
+            continue
         
-        if not all_posts:
-            await callback_query.message.answer(f"❌ Не удалось получить посты из каналов в папке {folder}")
+        sections = split_batch_response(response, list(labels))
+        for label, folder in labels.items():
+            if label not in sections:
+                logger.warning(f"В пакетном ответе нет раздела {label} (папка {folder}), анализирую отдельно")
+                continue
+            messages = flatten_messages(fetched[folder])
+            report_id = save_report(user_id, folder, sections[label], newest_post_date(messages))
+            checkpoints.set('report', folder, {'id': report_id, 'content': sections[label]})
+        logger.info(f"Пакетный запрос: {len(sections)} из {len(batch)} папок одним запросом")
+
+def job_summary(title: str, notes: list) -> str:
+    """Одно итоговое сообщение задачи вместо отдельного предупреждения на каждый канал"""
+    return "\n".join([title] + notes) if notes else title
+
+async def run_analysis_job(job: dict):
+    """Ручной анализ: папки из задачи, файлы уходят в чат пользователя группами в конце.
+    Посты, отчеты, файлы и факт отправки сохраняются в чекпоинты задачи"""
+    chat_id = job['chat_id']
+    user_id = job['user_id']
+    payload = job['payload']
+    format_type = payload['format']
+    hours = payload.get('hours', 24)
+    checkpoints = Checkpoints(job['id'])
+    formats = [fmt for fmt in ('txt', 'pdf') if format_type in (fmt, 'both')]
+    
+    pending = [folder for folder, _, _ in payload['folders'] if checkpoints.get('folder', folder) is None]
+    if pending:
+        await outbound.send_message(chat_id, f"Анализирую папки: {', '.join(pending)}...")
+    
+    # Сначала собираем посты всех папок, чтобы маленькие папки можно было объединить в один запрос
+    fetched = {}
+    folder_notes = {}
+    out_of_time = []  # папки, на которые не хватило бюджета времени
+    for folder, channels, prompt in payload['folders']:
+        if checkpoints.get('folder', folder) is not None or checkpoints.get('report', folder) is not None:
+            continue
+        left = time_left()
+        if left is not None and left <= DEADLINE_LLM_RESERVE:
+            continue
+        notes = folder_notes[folder] = []
+        
+        warnings = []
+        by_channel = await fetch_folder_messages(channels, folder, warnings, hours=hours, checkpoints=checkpoints)
+        if warnings:
+            notes.append(f"⚠️ {folder}: не удалось получить посты из {', '.join(warnings)}")
+        
+        if not by_channel:
+            notes.append(f"❌ Не удалось получить посты из каналов в папке {folder}")
+            checkpoints.set('folder', folder, notes)
+            continue
+        fetched[folder] = by_channel
+    
+    posts_texts = {}
+    if BATCH_FOLDERS and len(fetched) > 1:
+        await run_folder_batches(payload, fetched, posts_texts, user_id, hours, checkpoints)
+    
+    for folder, channels, prompt in payload['folders']:
+        if checkpoints.get('folder', folder) is not None:
+            continue
+        notes = folder_notes.setdefault(folder, [])
+        if checkpoints.get('report', folder) is None and folder not in fetched:
+            out_of_time.append(folder)
+            checkpoints.set('folder', folder, notes)
             continue
-            
-        posts_text = "\n\n---\n\n".join(all_posts)
-        prompt = user['prompts'][folder]
         
         try:
-            response = await try_gpt_request(prompt, posts_text, callback_query.from_user.id)
-            
-            # Сохраняем отчет в БД
-            save_report(callback_query.from_user.id, folder, response)
-            
-            files_to_send = []
-            
-            # Генерируем отчеты в выбранном формате
-            if format_type in ['txt', 'both']:
-                txt_filename = generate_txt_report(response, folder)
-                files_to_send.append(txt_filename)
+            report = checkpoints.get('report', folder)
+            if report is None:
+                by_channel = fetched[folder]
+                posts_text = posts_texts.get(folder) or await build_posts_text(by_channel, user_id, payload, hours)
+                with span('llm', folder=folder):
+                    response = await try_gpt_request(prompt, posts_text, user_id, model=payload['model'],
+                                                     provider_index=payload.get('provider_index'))
                 
-            if format_type in ['pdf', 'both']:
-                try:
-                    pdf_filename = generate_pdf_report(response, folder)
-                    files_to_send.append(pdf_filename)
-                except Exception as pdf_error:
-                    logger.error(f"Ошибка при создании PDF: {str(pdf_error)}")
-                    await callback_query.message.answer("⚠️ Не удалось создать PDF версию отчета")
+                # Сохраняем отчет в БД
+                report_id = save_report(user_id, folder, response, newest_post_date(flatten_messages(by_channel)))
+                checkpoints.set('report', folder, {'id': report_id, 'content': response})
+            else:
+                response = report['content']
             
-            # Отправляем файлы
-            for filename in files_to_send:
-                with open(filename, 'rb') as f:
-                    await callback_query.message.answer_document(
-                        f,
-                        caption=f"✅ Анализ для папки {folder} ({os.path.splitext(filename)[1][1:].upper()})"
-                    )
-                os.remove(filename)
+            # Генерируем отчеты в выбранном формате (готовые файлы берем из чекпоинта)
+            with span('render', folder=folder):
+                for fmt, render in REPORT_RENDERERS.items():
+                    if fmt not in formats:
+                        continue
+                    artifact = f"{folder}:{fmt}"
+                    filename = checkpoints.get('artifact', artifact)
+                    if checkpoints.get('sent', artifact) or (filename and os.path.exists(filename)):
+                        continue
+                    if fmt == 'pdf' and (time_left() or 0) < 0:
+                        notes.append(f"⚠️ {folder}: PDF не создан, бюджет времени исчерпан")
+                        continue
+                    try:
+                        with RENDER_SECONDS.time(format=fmt):
+                            filename = render(response, folder)
+                        checkpoints.set('artifact', artifact, filename)
+                    except Exception as render_error:
+                        if fmt == 'txt':
+                            raise
+                        logger.error(f"Ошибка при создании PDF: {str(render_error)}")
+                        notes.append(f"⚠️ {folder}: не удалось создать PDF версию отчета")
             
+        except DeadlineExceeded:
+            out_of_time.append(folder)
         except Exception as e:
             error_msg = f"❌ Ошибка при анализе папки {folder}: {str(e)}"
             logger.error(error_msg)
-            await callback_query.message.answer(error_msg)
+            notes.append(error_msg)
+        checkpoints.set('folder', folder, notes)
+    
+    # Отправляем все файлы задачи группами (sendMediaGroup) и запоминаем их file_id
+    documents = []
+    artifacts = {}
+    for folder, _, _ in payload['folders']:
+        report = checkpoints.get('report', folder)
+        for fmt in formats:
+            artifact = f"{folder}:{fmt}"
+            filename = checkpoints.get('artifact', artifact)
+            if report and filename and not checkpoints.get('sent', artifact) and os.path.exists(filename):
+                documents.append((filename, f"✅ Анализ для папки {folder} ({fmt.upper()})", None))
+                artifacts[filename] = (artifact, report['id'], fmt)
+    
+    def mark_sent(sent: list, file_ids: list):
+        for (filename, _, _), file_id in zip(sent, file_ids):
+            artifact, report_id, fmt = artifacts[filename]
+            save_report_file(report_id, fmt, file_id)
+            checkpoints.set('sent', artifact, True)
+            remove_report_file(filename)
+    
+    with span('send', files=len(documents)):
+        await outbound.send_documents(chat_id, documents, on_sent=mark_sent)
+    
+    notes = [note for folder, _, _ in payload['folders'] for note in checkpoints.get('folder', folder) or []]
+    if out_of_time:
+        notes.append(f"⏱ Время на анализ закончилось, не успели: {', '.join(out_of_time)}")
+    await outbound.send_message(chat_id, job_summary("✅ Анализ завершен!", notes))
+
+def out_of_time_note(folder: str) -> str:
+    return f"⏱ Время на анализ папки {folder} закончилось, отчет не готов"
+
+async def run_scheduled_job(job: dict):
+    """Анализ по расписанию: отчеты сохраняются в историю, пользователю уходит одно уведомление"""
+    user_id = job['user_id']
+    payload = job['payload']
+    checkpoints = Checkpoints(job['id'])
+    
+    for folder, channels, prompt in payload['folders']:
+        if checkpoints.get('folder', folder) is not None:
+            continue
+        
+        if checkpoints.get('report', folder) is None:
+            # Если прошлый отчет свежий, берем только посты после него
+            previous = get_last_report(user_id, folder) if DELTA_ANALYSIS else None
+            now = datetime.now(timezone.utc)
+            delta = (previous is not None and previous[1] is not None
+                     and previous[1] >= now - timedelta(hours=DELTA_MAX_AGE_HOURS))
+            # Окно выгрузки покрывает весь разрыв с cutoff прошлого отчета
+            hours = max(24, math.ceil((now - previous[1]).total_seconds() / 3600) + 1) if delta else 24
+            
+            left = time_left()
+            if left is not None and left <= DEADLINE_LLM_RESERVE:
+                checkpoints.set('folder', folder, [out_of_time_note(folder)])
+                continue
+            failed = []
+            by_channel = await fetch_folder_messages(channels, folder, since=previous[1] if delta else None,
+                                                     hours=hours, checkpoints=checkpoints, failed=failed)
+            messages = flatten_messages(by_channel)
+            left = time_left()
+            if not messages and left is not None and left <= DEADLINE_LLM_RESERVE:
+                checkpoints.set('folder', folder, [out_of_time_note(folder)])
+                continue
+            # "Нет новых постов" - только если каналы действительно удалось прочитать
+            fetched_channels = [c for c in channels if is_valid_channel(c) and c not in failed]
+            if not messages and delta and not fetched_channels:
+                logger.error(f"Не удалось получить посты ни из одного канала папки {folder}")
+                checkpoints.set('folder', folder, [f"❌ Не удалось получить посты из каналов папки {folder}, "
+                                                   f"автоматический анализ пропущен"])
+                continue
+            if not messages:
+                if delta:
+                    logger.info(f"Новых постов в папке {folder} после прошлого отчета нет")
+                    note = f"ℹ️ В папке {folder} нет новых постов с прошлого отчета"
+                    if failed:
+                        note += f" (не удалось прочитать: {', '.join(failed)})"
+                    checkpoints.set('folder', folder, [note])
+                else:
+                    logger.error(f"Не удалось получить посты для автоматического анализа папки {folder}")
+                    checkpoints.set('folder', folder, [])
+                continue
+                
+            if delta:
+                # Новых постов немного, выжимки каналов тут не нужны
+                logger.info(f"Дельта-анализ папки {folder}: {len(messages)} новых постов")
+                posts_text = "\n\n---\n\n".join(text for _, _, text in messages)
+                prompt = build_delta_prompt(prompt, previous[0])
+            else:
+                posts_text = await build_posts_text(by_channel, user_id, payload)
+            
+            try:
+                with span('llm', folder=folder):
+                    response = await try_gpt_request(prompt, posts_text, user_id, model=payload['model'],
+                                                     provider_index=payload.get('provider_index'))
+            except DeadlineExceeded:
+                checkpoints.set('folder', folder, [out_of_time_note(folder)])
+                continue
+            
+            # Сохраняем отчет
+            report_id = save_report(user_id, folder, response, newest_post_date(messages))
+            checkpoints.set('report', folder, {'id': report_id, 'content': response})
+            
+            # Логируем успешное завершение отчета
+            logger.info("отчет удался")
+        
+        checkpoints.set('folder', folder, [f"✅ Автоматический анализ папки {folder} завершен!"])
+    
+    # Отправляем одно уведомление по всем папкам
+    notes = [note for folder, _, _ in payload['folders'] for note in checkpoints.get('folder', folder) or []]
+    reports = any(checkpoints.get('report', folder) for folder, _, _ in payload['folders'])
+    if notes:
+        hint = ["Используйте '📊 История отчетов' чтобы просмотреть результат."] if reports else []
+        await outbound.send_message(user_id, job_summary("\n".join(notes), hint))
+
+# Выгрузка архива отчетов (/export): строки идут из курсора прямо в сжатый файл,
+# а файл режется на части, чтобы каждая пролезала в лимит Bot API на загрузку (50 МБ)
+EXPORT_FORMATS = ('jsonl', 'csv', 'txt')
+EXPORT_PART_BYTES = int(os.getenv('EXPORT_PART_BYTES', str(45 * 1024 * 1024)))
+EXPORT_FIELDS = ('id', 'folder', 'created_at', 'cutoff', 'content')
+EXPORT_BATCH = 200  # после каждой пачки строк отдаем управление циклу событий
+
+class ReportExportPart:
+    """Одна часть выгрузки: jsonl.gz, csv.gz или zip с TXT-файлами"""
+    def __init__(self, filename: str, format_type: str):
+        self.filename = filename
+        self.format_type = format_type
+        self.rows = 0
+        if format_type == 'txt':
+            self.archive = zipfile.ZipFile(filename, 'w', compression=zipfile.ZIP_DEFLATED)
+            self.raw = self.archive.fp
+        else:
+            self.raw = open(filename, 'wb')
+            self.text = io.TextIOWrapper(gzip.GzipFile(fileobj=self.raw, mode='wb'), encoding='utf-8', newline='')
+            if format_type == 'csv':
+                self.csv = csv.writer(self.text)
+                self.csv.writerow(EXPORT_FIELDS)
+
+    def write(self, row: tuple):
+        self.rows += 1
+        if self.format_type == 'txt':
+            report_id, folder, created_at, _, content = row
+            name = re.sub(r'[^\w.-]+', '_', f"{created_at[:16]}_{folder}_{report_id}")
+            self.archive.writestr(f"{name}.txt", content)
+        elif self.format_type == 'csv':
+            self.csv.writerow(row)
+        else:
+            self.text.write(json.dumps(dict(zip(EXPORT_FIELDS, row)), ensure_ascii=False) + "\n")
+
+    def size(self) -> int:
+        """Сколько сжатых байт уже записано (без буферов компрессора)"""
+        return self.raw.tell()
+
+    def close(self):
+        if self.format_type == 'txt':
+            self.archive.close()
+        else:
+            self.text.close()
+            self.raw.close()
+
+async def run_export_job(job: dict):
+    """Выгрузка отчетов пользователя частями; отправленные части отмечаются в чекпоинтах"""
+    chat_id = job['chat_id']
+    payload = job['payload']
+    format_type = payload['format']
+    checkpoints = Checkpoints(job['id'])
+    extension = {'jsonl': 'jsonl.gz', 'csv': 'csv.gz', 'txt': 'zip'}[format_type]
+    stamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    parts = []
+    total = 0
+    part = None
+    
+    async def deliver(finished: ReportExportPart):
+        finished.close()
+        number = len(parts) + 1
+        parts.append(finished.filename)
+        try:
+            if not checkpoints.get('sent', f"part{number}"):
+                await outbound.send_documents(chat_id, [(
+                    finished.filename, f"📦 Архив отчетов, часть {number} ({finished.rows} отчетов)", None
+                )])
+                checkpoints.set('sent', f"part{number}", True)
+        finally:
+            os.remove(finished.filename)
+    
+    with span('export', format=format_type):
+        for row in iter_user_reports(job['user_id'], payload.get('since'), payload.get('until'),
+                                     payload.get('folder'), batch_size=EXPORT_BATCH):
+            if part is None:
+                part = ReportExportPart(f"export_{job['user_id']}_{job['id']}_{stamp}_{len(parts) + 1}.{extension}",
+                                        format_type)
+            part.write(row)
+            total += 1
+            if total % EXPORT_BATCH == 0:
+                # Чтение и сжатие синхронные: не держим цикл событий до конца части
+                await asyncio.sleep(0)
+            if part.size() >= EXPORT_PART_BYTES:
+                await deliver(part)
+                part = None
+        if part is not None:
+            await deliver(part)
     
-    await callback_query.message.answer("✅ Анализ завершен!")
+    if total:
+        await outbound.send_message(chat_id, f"✅ Экспорт завершен: {total} отчетов, частей: {len(parts)}")
+    else:
+        await outbound.send_message(chat_id, "По заданным фильтрам отчетов не найдено")
+
+JOB_HANDLERS = {
+    'analysis': run_analysis_job,
+    'scheduled': run_scheduled_job,
+    'export': run_export_job,
+}
 
 @dp.message_handler(lambda message: message.text == "🔙 Назад", state="*")
 async def back_to_main_menu(message: types.Message, state: FSMContext):
@@ -1130,9 +3545,148 @@ async def remove_channel(callback_query: types.CallbackQuery):
         # Обновляем меню
         await edit_folder_menu(callback_query)
 
+# Воркеры анализа. ANALYSIS_WORKERS=0 - задачи выполняются в процессе бота,
+# N > 0 - бот запускает N процессов `python main.py --worker` и только ставит задачи
+ANALYSIS_WORKERS = int(os.getenv('ANALYSIS_WORKERS', '0'))
+WORKER_CONCURRENCY = int(os.getenv('WORKER_CONCURRENCY', '2'))  # задач одновременно в одном воркере
+WORKER_POLL_INTERVAL = float(os.getenv('WORKER_POLL_INTERVAL', '1'))
+JOB_HEARTBEAT_SECONDS = 15
+JOB_STALE_SECONDS = int(os.getenv('JOB_STALE_SECONDS', '120'))
+JOB_MAX_ATTEMPTS = int(os.getenv('JOB_MAX_ATTEMPTS', '3'))
+
+async def execute_job(job: dict, worker_id: str):
+    """Выполняем задачу, периодически отправляя heartbeat"""
+    run_id = new_run_id()
+    logger.info(f"Воркер {worker_id} взял задачу {job['id']} ({job['kind']}), запуск {run_id}")
+    
+    async def heartbeat():
+        while True:
+            await asyncio.sleep(JOB_HEARTBEAT_SECONDS)
+            heartbeat_job(job['id'])
+    
+    heartbeat_task = asyncio.ensure_future(heartbeat())
+    current_deadline.set(job.get('deadline'))
+    try:
+        await JOB_HANDLERS[job['kind']](job)
+        finish_job(job['id'], 'done')
+        JOBS_TOTAL.inc(kind=job['kind'], status='done')
+    except DeadlineExceeded as e:
+        # Повтор тоже не уложится в дедлайн
+        logger.warning(f"Задача {job['id']} не уложилась в бюджет времени: {str(e)}")
+        finish_job(job['id'], 'failed', str(e))
+        JOBS_TOTAL.inc(kind=job['kind'], status='deadline')
+    except Exception as e:
+        logger.error(f"Ошибка в задаче {job['id']}: {str(e)}")
+        if job['attempts'] < JOB_MAX_ATTEMPTS:
+            finish_job(job['id'], 'queued', str(e))
+            JOBS_TOTAL.inc(kind=job['kind'], status='retry')
+        else:
+            finish_job(job['id'], 'failed', str(e))
+            JOBS_TOTAL.inc(kind=job['kind'], status='failed')
+    finally:
+        heartbeat_task.cancel()
+
+async def worker_loop(worker_id: str, concurrency: int = WORKER_CONCURRENCY):
+    """Забираем задачи из очереди и выполняем до concurrency штук одновременно"""
+    slots = asyncio.Semaphore(concurrency)
+    running = set()
+    logger.info(f"Воркер {worker_id} запущен")
+    resumed = requeue_worker_jobs(worker_id, JOB_MAX_ATTEMPTS)
+    if resumed:
+        logger.info(f"Воркер {worker_id} продолжит незавершенные задачи: {resumed}")
+    while True:
+        requeued = requeue_stale_jobs(JOB_STALE_SECONDS, JOB_MAX_ATTEMPTS)
+        if requeued:
+            logger.warning(f"Возвращено в очередь зависших задач: {requeued}")
+        QUEUE_DEPTH.set(count_queued_jobs())
+        
+        await slots.acquire()
+        job = claim_job(worker_id)
+        if job is None:
+            slots.release()
+            await asyncio.sleep(WORKER_POLL_INTERVAL)
+            continue
+        
+        task = asyncio.ensure_future(execute_job(job, worker_id))
+        running.add(task)
+        task.add_done_callback(running.discard)
+        task.add_done_callback(lambda _: slots.release())
+
+async def supervise_workers(count: int):
+    """Запускаем процессы-воркеры и перезапускаем упавшие"""
+    processes = {}
+    try:
+        while True:
+            for index in range(count):
+                process = processes.get(index)
+                if process is not None and process.returncode is None:
+                    continue
+                if process is not None:
+                    logger.error(f"Воркер {index} завершился с кодом {process.returncode}, перезапускаю")
+                args = [sys.executable, os.path.abspath(__file__), '--worker', '--worker-id', f'w{index}']
+                if METRICS_PORT:
+                    args += ['--metrics-port', str(METRICS_PORT + 1 + index)]
+                processes[index] = await asyncio.create_subprocess_exec(*args)
+            await asyncio.sleep(5)
+    finally:
+        for process in processes.values():
+            if process.returncode is None:
+                process.terminate()
+
+async def shutdown(metrics_runner=None, tasks: list = ()):
+    """Аккуратно останавливаем все, что запустили в main() или worker_main()"""
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    if scheduler.running:
+        scheduler.shutdown(wait=False)
+    if client_pool is not None:
+        await client_pool.disconnect()
+    await dp.storage.close()
+    await dp.storage.wait_closed()
+    await close_http_connector()
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
+
+async def worker_main(worker_id: str, metrics_port: int):
+    """Точка входа процесса-воркера: Telethon, g4f и рендер без поллинга бота"""
+    global METRICS_PORT, client_pool
+    METRICS_PORT = metrics_port
+    metrics_runner = await start_metrics_server()
+    attach_bot_session()
+    background_tasks = []
+    start_loop_watchdog(background_tasks)
+    
+    try:
+        client_pool = ClientPool(TELETHON_SESSIONS, client_factory=create_worker_telethon_client)
+        await client_pool.start(interactive=False)
+        
+        if PUSH_INGESTION and worker_id == INGEST_WORKER_ID:
+            scheduler.start()
+            start_ingestion()
+        
+        await worker_loop(worker_id)
+    finally:
+        await shutdown(metrics_runner, background_tasks)
+
 async def main():
-    # Запускаем клиент Telethon
-    await client.start()
+    # Поднимаем /metrics
+    metrics_runner = await start_metrics_server()
+    
+    # Бот и провайдеры ходят в сеть через общий пул соединений
+    attach_bot_session()
+    
+    background_tasks = []
+    start_loop_watchdog(background_tasks)
+    try:
+        await run_bot(background_tasks)
+    finally:
+        await shutdown(metrics_runner, background_tasks)
+
+async def run_bot(background_tasks: list):
+    # Запускаем аккаунты Telethon (если задачи выполняются в этом же процессе)
+    if ANALYSIS_WORKERS == 0:
+        await get_client_pool().start()
     
     # Получаем инфу о боте
     me = await bot.get_me()
@@ -1140,10 +3694,21 @@ async def main():
     
     # Запускаем планировщик
     scheduler.start()
+    scheduler.add_job(prune_stored_posts, 'interval', hours=6, id='prune_stored_posts',
+                      replace_existing=True, next_run_time=datetime.now(pytz.UTC))
+    
+    if PUSH_INGESTION and ANALYSIS_WORKERS == 0:
+        start_ingestion()
+    
+    # Запускаем воркеры анализа
+    if ANALYSIS_WORKERS:
+        background_tasks.append(asyncio.ensure_future(supervise_workers(ANALYSIS_WORKERS)))
+    else:
+        background_tasks.append(asyncio.ensure_future(worker_loop('main')))
     
     # Восстанавливаем сохраненные расписания
-    for user_id, folder, time in get_active_schedules():
-        hour, minute = map(int, time.split(':'))
+    for user_id, folder, schedule_time in get_active_schedules():
+        hour, minute = map(int, schedule_time.split(':'))
         job_id = f"analysis_{user_id}_{folder}"
         
         scheduler.add_job(
@@ -1155,15 +3720,25 @@ async def main():
             replace_existing=True,
             args=[user_id, folder]
         )
-        logger.info(f"Восстановлено расписание: {job_id} в {time}")
+        logger.info(f"Восстановлено расписание: {job_id} в {schedule_time}")
     
     # Запускаем бота
     await dp.start_polling()
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--worker', action='store_true', help='запустить процесс-воркер анализа')
+    parser.add_argument('--worker-id', default=f'w{os.getpid()}')
+    parser.add_argument('--metrics-port', type=int, default=0)
+    cli_args = parser.parse_args()
+    if cli_args.worker:
+        try:
+            asyncio.run(worker_main(cli_args.worker_id, cli_args.metrics_port))
+        except KeyboardInterrupt:
+            logger.info(f"Воркер {cli_args.worker_id} остановлен")
+        sys.exit(0)
     try:
         asyncio.run(main())
     except KeyboardInterrupt:
-        # Останавливаем планировщик при выходе
-        scheduler.shutdown()
+        # Планировщик, клиенты и соединения уже остановлены в shutdown()
         logger.info("Бот остановлен") 
\ No newline at end of file
@@ -0,0 +1,32 @@
+"""Время холодного старта main.py: импорт укладывается в бюджет,
+тяжелые зависимости подгружаются только при первом использовании"""
+import os
+import subprocess
+import sys
+import tempfile
+
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import bench
+
+# Без зависимостей, которые main.py импортирует сразу, мерить нечего
+for module in ('aiogram', 'apscheduler', 'dotenv', 'pytz'):
+    pytest.importorskip(module)
+
+LAZY_MODULES = ('g4f', 'telethon', 'reportlab')
+
+
+def test_import_within_budget():
+    assert bench.check_startup(bench.STARTUP_BUDGET_MS)
+
+
+def test_heavy_dependencies_are_lazy():
+    workdir = tempfile.mkdtemp(prefix='suckfox_test_')
+    env = dict(os.environ, **bench.BENCH_ENV, LOG_FILE=os.path.join(workdir, 'bot.log'), PYTHONPATH=REPO_DIR)
+    code = f"import sys, main; print(' '.join(m for m in {LAZY_MODULES!r} if m in sys.modules))"
+    result = subprocess.run([sys.executable, '-c', code], cwd=workdir, env=env, capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr[-2000:]
+    assert result.stdout.strip() == ''